@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the overhead that Eigensheep adds around the user's code:
+# encoding and decoding values, building payloads, dispatching a map and
+# handling an invocation. Everything runs offline against the stand-in in
+# standin.py, and the results are written as JSON so that they can be
+# compared between releases:
+#
+#     python benchmarks/bench.py --output before.json
+#     python benchmarks/bench.py --output after.json --compare before.json
+
+from __future__ import print_function
+import contextlib
+import threading
+import tracemalloc
+import argparse
+import platform
+import warnings
+import json
+import time
+import sys
+import os
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import StandIn, load_lambda_module
+
+ALIAS = "benchmark"
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+QUICK_SIZES = [1024, 64 * 1024, 1024 * 1024]
+TASK_COUNTS = [1, 10, 100, 1000]
+QUICK_TASK_COUNTS = [1, 10, 100]
+
+
+def make_values(size):
+    """Values of several kinds which take up about `size` bytes"""
+    values = {
+        "bytes": os.urandom(size),
+        "ints": list(range(size // 8)),
+        "strings": dict(("key%d" % i, "value %d" % i) for i in range(size // 24)),
+    }
+    try:
+        import numpy
+
+        values["ndarray"] = numpy.random.random(size // 8)
+    except ImportError:
+        pass
+    return values
+
+
+def measure(fn, min_time=0.2, min_repeat=3):
+    """Run fn until it has taken min_time in total and return the fastest
+    and median times of a single run"""
+    times = []
+    while len(times) < min_repeat or sum(times) < min_time:
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"best": times[0], "median": times[len(times) // 2], "runs": len(times)}
+
+
+def bench_encode_decode(stand_in, sizes):
+    from eigensheep import template
+
+    results = []
+    for size in sizes:
+        for kind, value in sorted(make_values(size).items()):
+            encoded = template.encode_result(value)
+            encode = measure(lambda: template.encode_result(value))
+            decode = measure(lambda: template.decode_result(encoded))
+            results.append(
+                {
+                    "benchmark": "encode_decode",
+                    "params": {"size": size, "kind": kind},
+                    "metrics": {
+                        "encode_seconds": encode["median"],
+                        "decode_seconds": decode["median"],
+                        "encode_mb_per_second": size / encode["median"] / 1e6,
+                        "decode_mb_per_second": size / decode["median"] / 1e6,
+                        "encoded_bytes": len(json.dumps(encoded)),
+                        "spilled_to_s3": encoded["type"] == "s3",
+                    },
+                }
+            )
+    return results
+
+
+def bench_payload_json(stand_in, counts):
+    from eigensheep import template
+
+    results = []
+    for count in counts:
+        data = [template.encode_result(i) for i in range(count)]
+
+        def build():
+            for i, item in enumerate(data):
+                json.dumps(
+                    {
+                        "type": "RUN",
+                        "code": "DATA * 2",
+                        "index": i,
+                        "s3_bucket": "eigensheep-benchmark",
+                        "globals": {"CONSTANT": 42},
+                        "data": item,
+                    }
+                )
+
+        timing = measure(build)
+        results.append(
+            {
+                "benchmark": "payload_json",
+                "params": {"tasks": count},
+                "metrics": {
+                    "seconds": timing["median"],
+                    "seconds_per_task": timing["median"] / count,
+                },
+            }
+        )
+    return results
+
+
+def bench_map_dispatch(stand_in, counts):
+    from eigensheep import core
+
+    run_config = {
+        "box": {"runtime": "python3.7"},
+        "alias": ALIAS,
+        "code": "DATA",
+        "globals": {},
+    }
+
+    results = []
+    for count in counts:
+        data = list(range(count))
+        with quiet():
+            timing = measure(lambda: core.map(run_config, data), min_repeat=3)
+
+            tracemalloc.start()
+            core.map(run_config, data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        results.append(
+            {
+                "benchmark": "map_dispatch",
+                "params": {"tasks": count},
+                "metrics": {
+                    "seconds": timing["median"],
+                    "seconds_per_task": timing["median"] / count,
+                    "threads": threading.active_count(),
+                    "peak_traced_bytes": peak,
+                },
+            }
+        )
+    return results
+
+
+def bench_handler_latency(stand_in, repeat):
+    class Context:
+        invoked_function_arn = "arn:aws:lambda:local:0:function:Eigensheep:" + ALIAS
+
+    event = {
+        "type": "RUN",
+        "code": "DATA + INDEX",
+        "index": 1,
+        "s3_bucket": "eigensheep-benchmark",
+        "data": {"type": "b64+zlib+pickle", "data": ""},
+    }
+
+    from eigensheep import template
+
+    event["data"] = template.encode_result(41)
+
+    cold = []
+    for i in range(repeat):
+        # a cold start loads the template and then handles its first event
+        start = time.perf_counter()
+        module = load_lambda_module("cold%d" % i)
+        module.lambda_handler(event, Context())
+        cold.append(time.perf_counter() - start)
+
+    warm = measure(lambda: module.lambda_handler(event, Context()))
+    cold.sort()
+    return [
+        {
+            "benchmark": "handler_latency",
+            "params": {},
+            "metrics": {
+                "cold_seconds": cold[len(cold) // 2],
+                "warm_seconds": warm["median"],
+            },
+        }
+    ]
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide the output of the notebook side, such as progress bars"""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def start_notebook(stand_in, profiles=None):
+    """Import the notebook side of Eigensheep inside an IPython shell, with
+    boto3 routed to the stand-in, and the given profiles to other stand-ins"""
+    from IPython.testing.globalipapp import start_ipython
+
+    stand_in.install(profiles)
+    start_ipython()
+    with quiet():
+        from eigensheep import core
+    return core
+
+
+def compare(results, baseline):
+    """Print the ratio of every timing to the same timing in the baseline"""
+    previous = dict(
+        (json.dumps([r["benchmark"], r["params"]], sort_keys=True), r["metrics"])
+        for r in baseline["results"]
+    )
+    for result in results:
+        key = json.dumps([result["benchmark"], result["params"]], sort_keys=True)
+        if key not in previous:
+            continue
+        for metric, value in sorted(result["metrics"].items()):
+            before = previous[key].get(metric)
+            if metric.endswith("seconds") and before:
+                print(
+                    "%-16s %-40s %-16s %.2fx"
+                    % (
+                        result["benchmark"],
+                        json.dumps(result["params"], sort_keys=True),
+                        metric,
+                        value / before,
+                    )
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Eigensheep's overhead")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument(
+        "--quick", action="store_true", help="skip the largest sizes and counts"
+    )
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    counts = QUICK_TASK_COUNTS if args.quick else TASK_COUNTS
+
+    stand_in = StandIn(aliases=[ALIAS])
+    start_notebook(stand_in)
+
+    results = []
+    results += bench_encode_decode(stand_in, sizes)
+    results += bench_payload_json(stand_in, counts)
+    results += bench_map_dispatch(stand_in, counts)
+    results += bench_handler_latency(stand_in, 3 if args.quick else 10)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# A local stand-in for the parts of AWS Lambda and S3 that Eigensheep uses,
+# so that the notebook side and the Lambda side can be run together in a
+# single process without any network access or AWS credentials.
+#
+# The Lambda side runs from a separate copy of template.py, loaded the same
+# way the Lambda runtime loads main.py, so that it doesn't share globals
+# with the copy of the template that is imported by the notebook side.
+
+from __future__ import print_function
+import importlib.util
+import itertools
+import threading
+import datetime
+import base64
+import hashlib
+import json
+import time
+import io
+import os
+import sys
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "eigensheep",
+    "template.py",
+)
+
+ACCOUNT_ID = "000000000000"
+
+# The stand-in whose copy of the template is handling an invocation on this
+# thread, which clients created by the Lambda side are routed to
+current = threading.local()
+
+
+class ClientError(Exception):
+    def __init__(self, code, operation="StandIn"):
+        super(ClientError, self).__init__("%s (%s)" % (code, operation))
+        self.response = {"Error": {"Code": code}}
+
+
+class Exceptions:
+    ClientError = ClientError
+
+    class ResourceNotFoundException(ClientError):
+        def __init__(self):
+            ClientError.__init__(self, "ResourceNotFoundException")
+
+
+def load_lambda_module(name="main"):
+    """Load a fresh copy of the template, as a cold container would"""
+    spec = importlib.util.spec_from_file_location(name, TEMPLATE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StandInS3:
+    exceptions = Exceptions
+
+    def __init__(self, objects, modified):
+        self.objects = objects
+        self.modified = modified
+        self.uploads = {}
+        self.upload_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def head_bucket(self, Bucket):
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        if not isinstance(Body, bytes):
+            Body = Body.encode("utf-8")
+        self.objects[(Bucket, Key)] = bytes(Body)
+        self.touch(Bucket, Key)
+        return {"ETag": self.etag(Bucket, Key)}
+
+    def touch(self, Bucket, Key):
+        self.modified[(Bucket, Key)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY"):
+        body = self.get(CopySource["Bucket"], CopySource["Key"])
+        self.objects[(Bucket, Key)] = body
+        self.touch(Bucket, Key)
+        return {"CopyObjectResult": {"ETag": self.etag(Bucket, Key)}}
+
+    def etag(self, Bucket, Key):
+        return '"%s"' % hashlib.md5(self.objects[(Bucket, Key)]).hexdigest()
+
+    def get(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError("NoSuchKey", "GetObject")
+        return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        body = self.get(Bucket, Key)
+        return {"ContentLength": len(body), "ETag": self.etag(Bucket, Key)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        body = self.get(Bucket, Key)
+        etag = self.etag(Bucket, Key)
+        if IfMatch is not None and IfMatch != etag:
+            raise ClientError("PreconditionFailed", "GetObject")
+        res = {"ETag": etag}
+        if Range is not None:
+            first, last = Range[len("bytes=") :].split("-")
+            first = int(first)
+            last = int(last) + 1 if last else len(body)
+            if first >= len(body):
+                raise ClientError("InvalidRange", "GetObject")
+            last = min(last, len(body))
+            res["ContentRange"] = "bytes %d-%d/%d" % (first, last - 1, len(body))
+            body = body[first:last]
+        res["Body"] = io.BytesIO(body)
+        res["ContentLength"] = len(body)
+        return res
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = str(next(self.upload_ids))
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+        )
+        self.touch(Bucket, Key)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        keys = sorted(
+            k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+        )
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + 1000]
+        res = {
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": len(self.objects[(Bucket, key)]),
+                    "ETag": self.etag(Bucket, key),
+                    "LastModified": self.modified[(Bucket, key)],
+                }
+                for key in page
+            ],
+            "IsTruncated": start + 1000 < len(keys),
+        }
+        if res["IsTruncated"]:
+            res["NextContinuationToken"] = str(start + 1000)
+        return res
+
+    def get_paginator(self, name):
+        return Paginator(getattr(self, name))
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.objects.pop((Bucket, obj["Key"]), None)
+            self.modified.pop((Bucket, obj["Key"]), None)
+        return {}
+
+
+class Paginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+class Context:
+    def __init__(self, function_name, qualifier, timeout=900):
+        self.deadline = time.time() + timeout
+        self.function_name = function_name
+        self.invoked_function_arn = "arn:aws:lambda:local:%s:function:%s" % (
+            ACCOUNT_ID,
+            function_name,
+        )
+        if qualifier:
+            self.invoked_function_arn += ":" + qualifier
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+class StandInLambda:
+    """Runs every invocation in-process on the same warm copy of the
+    template, the way requests are handled by a single warm container"""
+
+    exceptions = Exceptions
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def list_aliases(self, FunctionName, Marker=None):
+        return {
+            "Aliases": [
+                {"Name": name, "FunctionVersion": version}
+                for name, version in sorted(self.stand_in.aliases.items())
+            ]
+        }
+
+    # Deployments only keep track of versions and aliases, as every
+    # version runs the same copy of the template
+
+    def update_function_configuration(self, FunctionName, **config):
+        self.stand_in.config = config
+        return {}
+
+    def update_function_code(self, FunctionName, Publish, ZipFile=None, **kwargs):
+        version = str(len(self.stand_in.versions) + 1)
+        self.stand_in.versions.append(version)
+        return {"Version": version}
+
+    def list_versions_by_function(self, FunctionName):
+        versions = ["$LATEST"] + self.stand_in.versions
+        return {"Versions": [{"Version": version} for version in versions]}
+
+    def get_alias(self, FunctionName, Name):
+        if Name not in self.stand_in.aliases:
+            raise Exceptions.ResourceNotFoundException()
+        return {"Name": Name, "FunctionVersion": self.stand_in.aliases[Name]}
+
+    def create_alias(self, FunctionName, Name, FunctionVersion):
+        self.stand_in.aliases[Name] = FunctionVersion
+        return {"Name": Name}
+
+    update_alias = create_alias
+
+    def delete_alias(self, FunctionName, Name):
+        self.stand_in.aliases.pop(Name, None)
+        return {}
+
+    def delete_function(self, FunctionName, Qualifier=None):
+        if Qualifier in self.stand_in.versions:
+            self.stand_in.versions.remove(Qualifier)
+        return {}
+
+    def invoke(
+        self, FunctionName, InvocationType, Payload="{}", Qualifier=None, LogType=None
+    ):
+        if FunctionName.startswith("arn:"):
+            parts = FunctionName.split(":")
+            FunctionName = parts[6]
+            Qualifier = parts[7] if len(parts) > 7 else Qualifier
+        if Qualifier and Qualifier not in self.stand_in.aliases:
+            raise Exceptions.ResourceNotFoundException()
+        if InvocationType == "DryRun":
+            return {}
+
+        event = json.loads(Payload)
+        try:
+            timeout = self.stand_in.config.get("Timeout", 900)
+            context = Context(FunctionName, Qualifier, timeout)
+            data = self.stand_in.handler(event, context)
+        except Exception as e:
+            data = {"errorMessage": str(e), "errorType": type(e).__name__}
+        return {
+            "Payload": io.BytesIO(json.dumps(data).encode("utf-8")),
+            "LogResult": base64.b64encode(b"").decode("utf-8"),
+        }
+
+
+class StandInSTS:
+    def get_caller_identity(self):
+        return {"Account": ACCOUNT_ID}
+
+
+class StandIn:
+    """Holds the state shared by every stand-in client: the objects in S3,
+    the aliases of the function, and the copy of the template which
+    handles invocations"""
+
+    def __init__(self, aliases=()):
+        self.objects = {}
+        self.modified = {}
+        self.aliases = dict((alias, "1") for alias in aliases)
+        self.versions = []
+        self.config = {}
+        self.lambda_module = load_lambda_module()
+        os.environ.setdefault("AWS_LAMBDA_LOG_STREAM_NAME", "standin/0")
+
+    def handler(self, event, context):
+        previous = getattr(current, "stand_in", None)
+        current.stand_in = self
+        try:
+            return self.lambda_module.lambda_handler(event, context)
+        finally:
+            current.stand_in = previous
+
+    def client(self, name, **kwargs):
+        if name == "s3":
+            return StandInS3(self.objects, self.modified)
+        elif name == "lambda":
+            return StandInLambda(self)
+        elif name == "sts":
+            return StandInSTS()
+        raise ValueError("No stand-in for the '%s' service" % name)
+
+    def install(self, profiles=None):
+        """Route boto3 sessions and clients to the stand-in. Sessions for
+        the profiles in `profiles` are routed to other stand-ins instead,
+        which act as separate deployments, such as ones in other regions."""
+        import boto3
+
+        profiles = profiles or {}
+        default = self
+
+        class Session:
+            def __init__(self, profile_name=None, **kwargs):
+                self.stand_in = profiles.get(profile_name, default)
+
+            def client(self, name, **kwargs):
+                return self.stand_in.client(name, **kwargs)
+
+        def client(name, **kwargs):
+            stand_in = getattr(current, "stand_in", None) or default
+            return stand_in.client(name, **kwargs)
+
+        boto3.session.Session = Session
+        boto3.client = client
@@ -2,4 +2,20 @@
 # -*- coding: utf-8 -*-
 
 # Re-export the public API for Eigensheep
-from eigensheep.core import save, load, invoke, map
+from eigensheep.core import (
+    save,
+    load,
+    invoke,
+    map,
+    map_s3,
+    map_reduce,
+    shuffle,
+    prewarm,
+    ResultStore,
+    LazyResult,
+    prefetch,
+    resolve,
+    submit,
+    Job,
+    collect_garbage,
+)
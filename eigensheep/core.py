@@ -2,17 +2,23 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from eigensheep.template import zipstr, encode_result, decode_result
+from eigensheep.template import zipstr, encode_result, decode_result, split_evenly
 import eigensheep.template as template
 from IPython.core.magic import Magics, magics_class, line_cell_magic
 from IPython.core.display import display, HTML, Javascript
 from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from IPython.core.error import UsageError
 from tqdm import tqdm_notebook as tqdm
 from ipywidgets import widgets
 from os.path import expanduser
 from types import ModuleType
+import contextlib
+import calendar
 import hashlib
+import inspect
+import linecache
+import textwrap
 import threading
 import boto3
 import argparse
@@ -20,11 +26,15 @@ import os
 import io
 import sys
 import zipfile
+import mmap
+import struct
+import multiprocessing
 import base64
 import zlib
 import time
 import pickle
 import json
+import uuid
 import ast
 import re
 
@@ -45,15 +55,35 @@ LAMBDA_TEMPLATE_PYTHON = open(
 DEFAULT_MEMORY = 512
 DEFAULT_TIMEOUT = 60
 MAX_CONCURRENCY = 1000
+PREFETCH_CONCURRENCY = 16
+ENCODE_CONCURRENCY = multiprocessing.cpu_count()
 
 
 BOOTSTRAP_CONFIG = {"memory": 3008, "timeout": 300}
 
+# Objects loaded in the notebook are cached here by ETag, and the least
+# recently used ones are removed when there are more than CACHE_SIZE bytes
+CACHE_DIR = expanduser("~/.eigensheep/cache")
+CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Garbage collection keeps unreferenced objects younger than GC_GRACE, as
+# they may belong to a map which is still starting, and drops the
+# references of jobs older than REF_MAX_AGE, which were never released
+GC_GRACE = 24 * 60 * 60
+REF_MAX_AGE = 7 * 24 * 60 * 60
+GC_MARKER = expanduser("~/.eigensheep/last_gc")
+
 threadLocal = threading.local()
 executor = None
+downloader = None
+encoder = None
+targets = None
+config = None
 storedLambdas = {}
 accountID = None
 known_aliases = set([])
+uploaded_bundles = set([])
+staged_objects = set([])
 
 IS_PYTHON2 = sys.version_info[0] == 2
 
@@ -101,6 +131,17 @@ parser.add_argument(
 parser.add_argument(
     "--layer", action="append", default=[], help="ARNs of lambda layers to include"
 )
+parser.add_argument(
+    "--prune",
+    action="append",
+    default=[],
+    help="leave files matching this pattern out of the dependency package",
+)
+parser.add_argument(
+    "--no_optimize",
+    action="store_true",
+    help="package dependencies exactly as pip installed them",
+)
 parser.add_argument(
     "--reinstall",
     action="store_true",
@@ -117,11 +158,52 @@ parser.add_argument(
 parser.add_argument(
     "--rm", action="store_true", help="remove a specific lambda configuration"
 )
+parser.add_argument(
+    "--gc",
+    action="store_true",
+    help="remove chunks, bundles and build packages which are no longer used",
+)
 parser.add_argument(
     "--name",
     type=str,
     help="store the lambda for later use with `eigensheep.map` or `eigensheep.invoke`",
 )
+parser.add_argument(
+    "--fanout",
+    type=int,
+    help="launch the invocations from inside lambda in a tree with this many branches per launcher",
+)
+parser.add_argument(
+    "--prewarm",
+    type=int,
+    help="start this many lambda containers before invoking the cell",
+)
+parser.add_argument(
+    "--store",
+    type=str,
+    help="write results to this file as they arrive instead of keeping them in memory",
+)
+parser.add_argument(
+    "--lazy",
+    action="store_true",
+    help="return results too large to send directly as handles which are downloaded when used",
+)
+parser.add_argument(
+    "--background",
+    action="store_true",
+    help="return a job immediately and run the invocations in the background",
+)
+parser.add_argument(
+    "--priority",
+    type=float,
+    default=1,
+    help="share of the concurrency for this cell relative to other running jobs",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="profile the cell inside lambda and report where the time went",
+)
 parser.add_argument(
     "--verbose",
     action="store_true",
@@ -136,7 +218,8 @@ def eprint(*args, **kwargs):
 def ensure_setup():
     global executor, known_aliases, accountID
     if executor is None:
-        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        concurrency = sum(target.concurrency for target in get_targets())
+        executor = ThreadPoolExecutor(max_workers=concurrency)
 
     # if we have already defined the lambda client skip the rest
     if hasattr(threadLocal, "lambdaClient"):
@@ -145,6 +228,11 @@ def ensure_setup():
     session = boto3.session.Session(profile_name=AWS_PROFILE)
     threadLocal.lambdaClient = session.client("lambda")
     threadLocal.s3Client = session.client("s3")
+    threadLocal.functionName = FUNCTION_NAME
+    threadLocal.target = get_targets()[0]
+    threadLocal.clients = {
+        AWS_PROFILE: (threadLocal.lambdaClient, threadLocal.s3Client)
+    }
 
     # if we have already loaded the accountID then skip the rest
     if accountID:
@@ -153,12 +241,13 @@ def ensure_setup():
 
     accountID = session.client("sts").get_caller_identity().get("Account")
     threadLocal.bucket = BUCKET_PREFIX + accountID
+    threadLocal.target.bucket = threadLocal.bucket
 
     # load all the known aliases
     aliases = threadLocal.lambdaClient.list_aliases(FunctionName=FUNCTION_NAME)[
         "Aliases"
     ]
-    known_aliases = set([ali["Name"] for ali in aliases])
+    known_aliases = set([(AWS_PROFILE, ali["Name"]) for ali in aliases])
 
     # check that the appropriate bucket exists
     threadLocal.s3Client.head_bucket(Bucket=threadLocal.bucket)
@@ -168,6 +257,149 @@ def ensure_setup():
         raise Exception("No lambda exists with name '%s'." % FUNCTION_NAME)
 
 
+# Maps can be spread over several deployments of Eigensheep, such as stacks
+# in other regions or accounts, to go beyond the concurrency of a single
+# function. Each deployment is a target, described by a profile of the AWS
+# config, and the eigensheep profile lists the other targets by name.
+class Target(object):
+    def __init__(self, profile, function, bucket, concurrency):
+        self.profile = profile
+        self.function = function
+        self.bucket = bucket
+        self.concurrency = concurrency
+
+    def __repr__(self):
+        return "<Target %s>" % self.profile
+
+
+def get_targets():
+    """The targets that maps can be spread over. The first is always the
+    one from the eigensheep profile, which is used for everything else."""
+    global targets
+    if targets is not None:
+        return targets
+
+    option = get_option
+
+    def read_target(profile):
+        return Target(
+            profile,
+            option(profile, "eigensheep_function", FUNCTION_NAME),
+            option(profile, "eigensheep_bucket"),
+            int(option(profile, "eigensheep_concurrency", MAX_CONCURRENCY)),
+        )
+
+    home = Target(
+        AWS_PROFILE,
+        FUNCTION_NAME,
+        None,
+        int(option(AWS_PROFILE, "eigensheep_concurrency", MAX_CONCURRENCY)),
+    )
+    names = option(AWS_PROFILE, "eigensheep_targets", "").split(",")
+    targets = [home] + [read_target(name.strip()) for name in names if name.strip()]
+    return targets
+
+
+def get_option(profile, name, default=None):
+    """Read a setting from a profile of the AWS config"""
+    global config
+    if config is None:
+        try:
+            import ConfigParser as configparser
+        except ImportError:
+            import configparser
+
+        config = configparser.ConfigParser()
+        config.read(expanduser(os.environ.get("AWS_CONFIG_FILE", "~/.aws/config")))
+
+    section = "profile " + profile
+    if config.has_option(section, name):
+        return config.get(section, name)
+    return default
+
+
+@contextlib.contextmanager
+def use_target(target):
+    """Point the clients, bucket and function of this thread at a target,
+    or at the first target if it's None, until the block is done"""
+    ctx = get_ctx()
+    target = target or get_targets()[0]
+    previous = ctx.target
+    if target is not previous:
+        switch_target(ctx, target)
+    try:
+        yield ctx
+    finally:
+        if target is not previous:
+            switch_target(ctx, previous)
+
+
+def switch_target(ctx, target):
+    if target.profile not in ctx.clients:
+        session = boto3.session.Session(profile_name=target.profile)
+        ctx.clients[target.profile] = (session.client("lambda"), session.client("s3"))
+        if target.bucket is None:
+            identity = session.client("sts").get_caller_identity()
+            target.bucket = BUCKET_PREFIX + identity["Account"]
+    ctx.lambdaClient, ctx.s3Client = ctx.clients[target.profile]
+    ctx.bucket = target.bucket
+    ctx.functionName = target.function
+    ctx.target = target
+
+
+def for_each_target(fn, *args):
+    """Call fn with every target in use, at the same time, and return what
+    each call returned"""
+    pool = get_targets()
+    if len(pool) == 1:
+        return [fn(*args)]
+
+    results = [None] * len(pool)
+    errors = []
+
+    def run(i, target):
+        try:
+            with use_target(target):
+                results[i] = fn(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=(i, target)) for i, target in enumerate(pool)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def alias_key(alias):
+    """Aliases are known separately for every target"""
+    return (get_ctx().target.profile, alias)
+
+
+def stage_payload(payload, target, alias):
+    """Rewrite a payload to run on another target, copying the bundle it
+    needs from the first target's bucket into the target's bucket. Inputs
+    are encoded for the target directly, so large ones are already there."""
+    payload = dict(payload)
+    key = payload.get("bundle")
+    if key is not None and (target.profile, key) not in staged_objects:
+        with use_target(None):
+            contents = load(key, cache=False)
+        with use_target(target):
+            template.add_reference("aliases/" + alias, key)
+            save(key, contents)
+        staged_objects.add((target.profile, key))
+
+    with use_target(target) as ctx:
+        payload["s3_bucket"] = ctx.bucket
+    return payload
+
+
 def lambda_exists(name, alias):
     ctx = get_ctx()
     global known_aliases
@@ -179,10 +411,9 @@ def lambda_exists(name, alias):
         else:
             ctx.lambdaClient.invoke(FunctionName=name, InvocationType="DryRun")
     except ctx.lambdaClient.exceptions.ResourceNotFoundException:
-        if alias in known_aliases:
-            known_aliases.remove(alias)
+        known_aliases.discard(alias_key(alias))
         return False
-    known_aliases.add(alias)
+    known_aliases.add(alias_key(alias))
     return True
 
 
@@ -340,6 +571,7 @@ DATA + INDEX
 This means each lambda runnning in parallel gets a different INDEX variable, which is useful for doing different jobs on each one.
 Check out the examples for inspiration.</li>
 <li><tt>DATA</tt>: the data corresponding to a particular index.</li>
+<li><tt>CANCELLED()</tt>: whether the map was cancelled or interrupted, so that long running cells can stop early.</li>
 </ul>
 </details>
 
@@ -363,6 +595,7 @@ These APIs are available from both the parent notebook and the Lambda environmen
 <ul>
 <li><tt>SAVE(key, data)</tt>: saves <tt>data</tt> to a file named <tt>key</tt> in the Eigensheep S3 bucket.<br/></li>
 <li><tt>LOAD(key)</tt>: returns the contents of the file named <tt>key</tt> in the Eigensheep S3 bucket.<br/></li>
+<li><tt>LOAD(key, start, end)</tt>: returns bytes <tt>start</tt> up to <tt>end</tt> of the file, and <tt>LOAD(key, stream=True)</tt> returns a file-like object.<br/></li>
 </ul>
 </details>
 """
@@ -384,7 +617,11 @@ class EigensheepMagics(Magics):
             return
 
         if args.clean:
-            remove_all_aliases()
+            for_each_target(remove_all_aliases)
+            return
+
+        if args.gc:
+            collect_garbage()
             return
 
         if not cell:
@@ -401,34 +638,19 @@ class EigensheepMagics(Magics):
             "runtime": args.runtime,
             "layers": args.layer,
         }
+        if args.prune:
+            box_config["prune"] = args.prune
+        if args.no_optimize:
+            box_config["optimize"] = False
 
         alias = make_alias_name(box_config)
 
         if args.rm or args.reinstall:
-            ctx = get_ctx()
-            try:
-                ali = ctx.lambdaClient.get_alias(FunctionName=FUNCTION_NAME, Name=alias)
-                if alias in known_aliases:
-                    known_aliases.remove(alias)
-                ctx.lambdaClient.delete_alias(
-                    FunctionName=FUNCTION_NAME, Name=ali["Name"]
-                )
-                ctx.lambdaClient.delete_function(
-                    FunctionName=FUNCTION_NAME, Qualifier=ali["FunctionVersion"]
-                )
-                eprint('Deleted alias "%s".' % alias)
-
-            except ctx.lambdaClient.exceptions.ResourceNotFoundException:
-                pass
-
+            for_each_target(remove_alias, alias)
             if args.rm:
                 return
 
-        if (
-            not args.no_install
-            and alias not in known_aliases
-            and not lambda_exists(FUNCTION_NAME, alias)
-        ):
+        if not args.no_install:
             ensure_deps(box_config)
 
         try:
@@ -436,17 +658,7 @@ class EigensheepMagics(Magics):
         except SyntaxError as err:
             raise QuietError(err)
 
-        names = set(node.id for node in ast.walk(root) if isinstance(node, ast.Name))
-        exported_vars = names.intersection(ipython.user_ns.keys())
-        exported_globals = {}
-
-        for key in exported_vars:
-            val = ipython.user_ns[key]
-            try:
-                json.dumps(val)
-                exported_globals[key] = val
-            except:
-                pass
+        exported_globals, definitions, modules = collect_exports(root)
 
         run_config = {
             "box": box_config,
@@ -456,6 +668,9 @@ class EigensheepMagics(Magics):
             "globals": exported_globals,
         }
 
+        if definitions or modules:
+            run_config["bundle"] = upload_bundle(definitions, modules, alias)
+
         if args.name:
             storedLambdas[args.name] = run_config
             eprint(
@@ -464,12 +679,262 @@ class EigensheepMagics(Magics):
             )
             return None
 
+        options = {
+            "fanout": args.fanout,
+            "prewarm": args.prewarm,
+            "store": args.store,
+            "lazy": args.lazy,
+            "background": args.background,
+            "priority": args.priority,
+            "profile": args.profile,
+        }
         if args.data:
-            return map(run_config, ipython.user_ns[args.data])
-        elif args.n > 1:
-            return map(run_config, range(args.n))
+            return map(run_config, ipython.user_ns[args.data], **options)
+        elif args.n > 1 or args.background:
+            return map(run_config, range(args.n), **options)
+        else:
+            return invoke(run_config, profile=args.profile)
+
+
+# Cells can use the functions and classes defined in other cells of the
+# notebook, and local modules, which are shipped to Lambda by their source
+# code in a bundle. These are found by following the names used by the
+# cell, and then the names used by the source of each definition.
+def collect_exports(root):
+    exported_globals = {}
+    definitions = []
+    modules = {}
+    seen = set()
+
+    def visit(tree, imports_only=False):
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and not imports_only:
+                visit_name(node.id)
+            elif isinstance(node, ast.Import):
+                for name in node.names:
+                    visit_module(name.name.split(".")[0])
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                visit_module(node.module.split(".")[0])
+
+    def visit_name(name):
+        if name in seen or name not in ipython.user_ns:
+            return
+        seen.add(name)
+        val = ipython.user_ns[name]
+
+        if isinstance(val, ModuleType):
+            visit_module(val.__name__.split(".")[0])
+        elif (
+            inspect.isfunction(val) or inspect.isclass(val)
+        ) and val.__module__ == "__main__":
+            original = val.__name__
+            if original != name and ipython.user_ns.get(original) is val:
+                visit_name(original)
+                definitions.append("%s = %s\n" % (name, original))
+                return
+            source = definition_source(name, val)
+            if source is not None:
+                # definitions come after those that they refer to
+                visit(ast.parse(source))
+                definitions.append(source)
+        else:
+            try:
+                json.dumps(val)
+                exported_globals[name] = val
+            except:
+                pass
+
+    def visit_module(name):
+        if "module:" + name in seen:
+            return
+        seen.add("module:" + name)
+        path = local_module_path(sys.modules.get(name))
+        if path:
+            modules[name] = path
+            for source in module_sources(name, path).values():
+                try:
+                    visit(ast.parse(source), imports_only=True)
+                except SyntaxError:
+                    pass
+
+    visit(root)
+    return exported_globals, definitions, modules
+
+
+def definition_source(name, val):
+    try:
+        if inspect.isclass(val):
+            source = class_source(val)
         else:
-            return invoke(run_config)
+            source = textwrap.dedent(inspect.getsource(val))
+        tree = ast.parse(source)
+    except (IOError, OSError, TypeError, SyntaxError, AttributeError):
+        eprint("Unable to find the source code of '%s', it won't be available." % name)
+        return None
+
+    if val.__name__ == "<lambda>":
+        # the source of a lambda is the whole line it's on, which is only
+        # safe to run again if it does nothing but assign the lambda
+        stmts = tree.body
+        if not (
+            len(stmts) == 1
+            and isinstance(stmts[0], ast.Assign)
+            and isinstance(stmts[0].targets[0], ast.Name)
+            and isinstance(stmts[0].value, ast.Lambda)
+        ):
+            eprint("Unable to ship the lambda '%s', define it with def instead." % name)
+            return None
+        target = stmts[0].targets[0].id
+    else:
+        target = val.__name__
+
+    if target != name:
+        source += "\n%s = %s\n" % (name, target)
+    return source
+
+
+def class_source(cls):
+    """inspect.getsource can't find classes defined in notebook cells, as
+    __main__ has no file, so look for the class around one of its methods"""
+    try:
+        return textwrap.dedent(inspect.getsource(cls))
+    except (IOError, OSError, TypeError):
+        pass
+    for member in vars(cls).values():
+        if not inspect.isfunction(member):
+            continue
+        code = member.__code__
+        lines = linecache.getlines(code.co_filename)
+        for node, block in statements(ast.parse("".join(lines))):
+            if isinstance(node, ast.ClassDef) and node.name == cls.__name__:
+                start = statement_start(node)
+                end = statement_end(node, block, lines)
+                if start <= code.co_firstlineno <= end:
+                    return textwrap.dedent("".join(lines[start - 1 : end]))
+    raise IOError("could not find class definition")
+
+
+def statements(tree):
+    """Every statement in a tree, along with the block it belongs to"""
+    for node in ast.walk(tree):
+        for field in ("body", "orelse", "finalbody"):
+            block = getattr(node, field, None)
+            if isinstance(block, list):
+                for stmt in block:
+                    if isinstance(stmt, ast.stmt):
+                        yield stmt, block
+
+
+def statement_start(node):
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+def statement_end(node, block, lines):
+    """The last line of a statement. Before Python 3.8 this isn't recorded,
+    so it's the last line of code before the next statement in its block,
+    or before the end of the source if there is none."""
+    if getattr(node, "end_lineno", None) is not None:
+        return node.end_lineno
+    following = [statement_start(s) for s in block if s.lineno > node.lineno]
+    end = min(following) - 1 if following else len(lines)
+    while end > node.lineno:
+        line = lines[end - 1].strip()
+        if line and not line.startswith("#"):
+            break
+        end -= 1
+    return end
+
+
+def local_module_path(module):
+    """Modules which live in the working directory are local, rather than
+    installed packages, and need to be shipped with the code"""
+    path = getattr(module, "__file__", None)
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    if hasattr(module, "__path__"):
+        path = os.path.dirname(path)
+    elif path.endswith(".pyc"):
+        path = path[:-1]
+    cwd = os.path.realpath(os.getcwd())
+    if not path.startswith(cwd + os.sep) or "site-packages" in path:
+        return None
+    # Python itself may be installed under the working directory, such as
+    # with pyenv or conda when the notebook is started from the home directory
+    for prefix in installed_prefixes():
+        if path == prefix or path.startswith(prefix + os.sep):
+            return None
+    return path
+
+
+def installed_prefixes():
+    import sysconfig
+
+    prefixes = [
+        sys.prefix,
+        getattr(sys, "base_prefix", sys.prefix),
+        sys.exec_prefix,
+        getattr(sys, "base_exec_prefix", sys.exec_prefix),
+    ]
+    paths = sysconfig.get_paths()
+    prefixes += [
+        paths[name] for name in ("stdlib", "purelib", "platlib") if name in paths
+    ]
+    return set(os.path.realpath(prefix) for prefix in prefixes if prefix)
+
+
+def module_sources(name, path):
+    if not os.path.isdir(path):
+        files = [(name + ".py", path)]
+    else:
+        files = []
+        for root, dirs, names in os.walk(path):
+            for file in names:
+                if file.endswith(".py"):
+                    relative = os.path.relpath(os.path.join(root, file), path)
+                    files.append(
+                        (os.path.join(name, relative), os.path.join(root, file))
+                    )
+    sources = {}
+    for relative, file in files:
+        try:
+            with open(file, "r") as f:
+                sources[relative] = f.read()
+        except UnicodeDecodeError:
+            # the source is decoded with the locale's encoding, which isn't
+            # necessarily the one the file was written in
+            eprint("Unable to read '%s', it won't be available." % relative)
+    return sources
+
+
+def upload_bundle(definitions, modules, alias):
+    """Save the bundle of notebook code to S3 under a key derived from its
+    contents, so that an unchanged bundle is never uploaded twice and
+    warm containers can keep it unpacked"""
+    ctx = get_ctx()
+    files = {"__definitions__.py": "\n\n".join(definitions)}
+    for name, path in modules.items():
+        files.update(module_sources(name, path))
+
+    pseudofile = io.BytesIO()
+    zipf = zipfile.ZipFile(pseudofile, "w", zipfile.ZIP_DEFLATED)
+    for path in sorted(files):
+        zipstr(zipf, path, files[path])
+    zipf.close()
+    contents = pseudofile.getvalue()
+
+    key = "bundles/%s.zip" % hashlib.sha256(contents).hexdigest()
+    if (alias, key) in uploaded_bundles:
+        return key
+    # bundles are kept for as long as an alias which uses them exists
+    template.add_reference("aliases/" + alias, key)
+    try:
+        template.touch(key)
+    except ctx.s3Client.exceptions.ClientError:
+        save(key, contents)
+    uploaded_bundles.add((alias, key))
+    return key
 
 
 def make_alias_name(box_config):
@@ -480,6 +945,10 @@ def make_alias_name(box_config):
         h.update(req.encode("utf-8"))
     for req in box_config.get("layers", []):
         h.update(req.encode("utf-8"))
+    for pattern in box_config.get("prune", []):
+        h.update(pattern.encode("utf-8"))
+    if not box_config.get("optimize", True):
+        h.update(b"no_optimize")
     reqs = "_".join(re.sub("[^\\w]", "", x) for x in requirements)[:50]
 
     if reqs == "":
@@ -495,25 +964,41 @@ def make_alias_name(box_config):
     ) + reqs
 
 
+def remove_alias(alias):
+    ctx = get_ctx()
+    try:
+        ali = ctx.lambdaClient.get_alias(FunctionName=ctx.functionName, Name=alias)
+        known_aliases.discard(alias_key(alias))
+        ctx.lambdaClient.delete_alias(FunctionName=ctx.functionName, Name=ali["Name"])
+        ctx.lambdaClient.delete_function(
+            FunctionName=ctx.functionName, Qualifier=ali["FunctionVersion"]
+        )
+        eprint('Deleted alias "%s".' % alias)
+
+    except ctx.lambdaClient.exceptions.ResourceNotFoundException:
+        pass
+
+
 def remove_all_aliases():
-    global known_aliases
     ctx = get_ctx()
-    aliases = ctx.lambdaClient.list_aliases(FunctionName=FUNCTION_NAME)["Aliases"]
-    versions = ctx.lambdaClient.list_versions_by_function(FunctionName=FUNCTION_NAME)[
-        "Versions"
-    ]
+    aliases = ctx.lambdaClient.list_aliases(FunctionName=ctx.functionName)["Aliases"]
+    versions = ctx.lambdaClient.list_versions_by_function(
+        FunctionName=ctx.functionName
+    )["Versions"]
 
     for ali in aliases:
-        ctx.lambdaClient.delete_alias(FunctionName=FUNCTION_NAME, Name=ali["Name"])
+        ctx.lambdaClient.delete_alias(FunctionName=ctx.functionName, Name=ali["Name"])
 
     for ver in versions:
         if ver["Version"] == "$LATEST":
             continue
         ctx.lambdaClient.delete_function(
-            FunctionName=FUNCTION_NAME, Qualifier=ver["Version"]
+            FunctionName=ctx.functionName, Qualifier=ver["Version"]
         )
 
-    known_aliases = set([])
+    for key in list(known_aliases):
+        if key[0] == ctx.target.profile:
+            known_aliases.discard(key)
     eprint("Removed %d aliases, and %d versions" % (len(aliases), len(versions) - 1))
 
 
@@ -521,11 +1006,11 @@ def create_or_update_alias(version, alias):
     ctx = get_ctx()
     try:
         return ctx.lambdaClient.update_alias(
-            FunctionName=FUNCTION_NAME, Name=alias, FunctionVersion=version
+            FunctionName=ctx.functionName, Name=alias, FunctionVersion=version
         )
     except ctx.lambdaClient.exceptions.ResourceNotFoundException:
         return ctx.lambdaClient.create_alias(
-            FunctionName=FUNCTION_NAME, Name=alias, FunctionVersion=version
+            FunctionName=ctx.functionName, Name=alias, FunctionVersion=version
         )
 
 
@@ -545,7 +1030,7 @@ def update_lambda_config(box_config):
     handler = "main.lambda_handler"
 
     ctx.lambdaClient.update_function_configuration(
-        FunctionName=FUNCTION_NAME,
+        FunctionName=ctx.functionName,
         Timeout=timeout,
         Runtime=runtime,
         MemorySize=memory,
@@ -555,8 +1040,14 @@ def update_lambda_config(box_config):
 
 
 def ensure_deps(box_config):
+    """Deploy the configuration to every target which doesn't have it yet"""
+    for_each_target(deploy, box_config)
+
+
+def deploy(box_config):
+    ctx = get_ctx()
     alias = make_alias_name(box_config)
-    if lambda_exists(FUNCTION_NAME, alias):
+    if alias_key(alias) in known_aliases or lambda_exists(ctx.functionName, alias):
         return
     if len(box_config.get("requirements", [])) == 0:
         package_contents = build_minimal_lambda_package()
@@ -564,22 +1055,26 @@ def ensure_deps(box_config):
             eprint("Installing lambda layers (this will take a while)...")
         update_lambda_config(box_config)
         result = ctx.lambdaClient.update_function_code(
-            FunctionName=FUNCTION_NAME, ZipFile=package_contents, Publish=True
+            FunctionName=ctx.functionName, ZipFile=package_contents, Publish=True
         )
     else:
         BOOTSTRAP_CONFIG["runtime"] = box_config["runtime"]
         bootstrap_alias = make_alias_name(BOOTSTRAP_CONFIG)
-        ensure_deps(BOOTSTRAP_CONFIG)
+        deploy(BOOTSTRAP_CONFIG)
         eprint("Installing dependencies (this will take a while)...")
         payload = {
             "type": "BUILD",
             "requirements": box_config["requirements"],
             "s3_bucket": ctx.bucket,
-            "s3_key": "lambda_package.zip",
+            "s3_key": "builds/%s.zip" % alias,
+            "prune": box_config.get("prune", []),
+            "optimize": box_config.get("optimize", True),
         }
+        # invoke_thread runs on the first target unless it's told otherwise
         result = invoke_thread(
             {
                 "alias": bootstrap_alias,
+                "target": ctx.target,
                 "verbose": False,
                 "redirectStdout": True,
                 "payload": json.dumps(payload),
@@ -588,36 +1083,202 @@ def ensure_deps(box_config):
         if "errorMessage" in result:
             eprint(result)
             raise Exception(result["errorMessage"])
+        report_package(result.get("report", {}))
         if len(box_config.get("layers", [])) > 0:
             eprint("Installing lambda layers (this will take a while)...")
         update_lambda_config(box_config)
         result = ctx.lambdaClient.update_function_code(
-            FunctionName=FUNCTION_NAME,
+            FunctionName=ctx.functionName,
             S3Bucket=payload["s3_bucket"],
             S3Key=payload["s3_key"],
             Publish=True,
         )
-        # TODO: clean up the S3 package afterwards
-        # This isn't a huge problem because we write to the same
-        # S3 key each time, so this doesn't actually grow in size.
+        # Lambda keeps its own copy of the code, so the package can go
+        delete_keys([payload["s3_key"]])
 
     create_or_update_alias(result["Version"], alias)
-    eprint("Successfully deployed as '%s'." % alias)
+    if len(get_targets()) > 1:
+        eprint("Successfully deployed as '%s' to %s." % (alias, ctx.target.profile))
+    else:
+        eprint("Successfully deployed as '%s'." % alias)
+
+
+def report_package(report):
+    if "size_before" not in report:
+        return
+    eprint(
+        "Slimmed dependencies from %.1fMB to %.1fMB (%.1fMB zipped)"
+        % (
+            report["size_before"] / 1e6,
+            report["size_after"] / 1e6,
+            report["zip_size"] / 1e6,
+        )
+    )
+    if report["import_before"] is not None and report["import_after"] is not None:
+        eprint(
+            "Importing them took %.2fs before and %.2fs after"
+            % (report["import_before"], report["import_after"])
+        )
 
 
 def invoke_thread(info):
+    with use_target(info.get("target")):
+        return handle_response(invoke_raw(info), info.get("lazy", False))
+
+
+# Launchers return the raw responses of every task they started, along
+# with the log tail of each one, which we print as if we had invoked it
+def launch_thread(info):
+    data = invoke_raw(info)
+    if not isinstance(data, dict) or "results" not in data:
+        return [handle_response(data, info.get("lazy", False))] * info["count"]
+
+    # tasks which were still running when their launcher gave up on them
+    # can't take longer than the timeout from now to save their responses
+    deadline = time.time() + info["timeout"]
+    results = []
+    for child in decode_result(data["results"]):
+        if isinstance(child, dict) and child.get("type") == "pending":
+            child = wait_for_response(child["s3_key"], deadline)
+        if isinstance(child, dict):
+            print_log(child.pop("log", ""), info)
+            collect_profile(child, info)
+            collect_chunk(child, info)
+        results.append(handle_response(child, info.get("lazy", False)))
+    return results
+
+
+def wait_for_response(key, deadline):
     ctx = get_ctx()
-    result = ctx.lambdaClient.invoke(
-        FunctionName=FUNCTION_NAME,
-        InvocationType="RequestResponse",
-        LogType="Tail",
-        Payload=info["payload"],
-        Qualifier=info["alias"],
+    while True:
+        try:
+            return json.loads(load(key, cache=False))
+        except ctx.s3Client.exceptions.ClientError:
+            if time.time() > deadline:
+                return {
+                    "errorMessage": "The task outlived its launcher "
+                    "but never saved its response",
+                    "errorType": "LauncherTimeout",
+                }
+            time.sleep(1)
+
+
+def invoke_raw(info):
+    target = info.get("target")
+    payload = info["payload"]
+    if isinstance(payload, dict):
+        with use_target(target):
+            payload = prepare_payload(info)
+        if target is not None:
+            payload = stage_payload(payload, target, info["alias"])
+        payload = json.dumps(payload)
+
+    with use_target(target) as ctx:
+        result = ctx.lambdaClient.invoke(
+            FunctionName=ctx.functionName,
+            InvocationType="RequestResponse",
+            LogType="Tail",
+            Payload=payload,
+            Qualifier=info["alias"],
+        )
+
+        known_aliases.add(alias_key(info["alias"]))
+        data = json.load(result["Payload"])
+        print_log(base64.b64decode(result["LogResult"]).decode("utf-8"), info)
+        collect_profile(data, info)
+        collect_chunk(data, info)
+    return data
+
+
+# The inputs of a map are compressed in order by a pool of threads (zlib
+# releases the GIL) rather than all at once before the first invocation,
+# and the large ones are uploaded by the threads which invoke each task,
+# so that the first tasks are already running while the rest are encoded.
+def prepare_payload(info):
+    if "input" not in info:
+        return info["payload"]
+    packed = info["input"].result()
+    encoded = template.spill_result(packed, "jobs/" + info["payload"]["job"])
+    if encoded["type"] == "s3":
+        info["chunks"].append(encoded["s3_key"])
+    return dict(info["payload"], data=encoded)
+
+
+def collect_chunk(data, info):
+    """Keep track of the chunks a job's results were sent back through, so
+    that its references to them can be released once they're downloaded.
+    Lazy results are downloaded later, so their chunks stay referenced."""
+    if info.get("chunks") is None or info.get("lazy"):
+        return
+    if isinstance(data, dict) and isinstance(data.get("result"), dict):
+        if data["result"].get("type") == "s3":
+            info["chunks"].append(data["result"]["s3_key"])
+
+
+def get_encoder():
+    global encoder
+    if encoder is None:
+        encoder = ThreadPoolExecutor(max_workers=ENCODE_CONCURRENCY)
+    return encoder
+
+
+def collect_profile(data, info):
+    if isinstance(data, dict) and "profile" in data:
+        profile = decode_result(data.pop("profile"))
+        if info.get("profiles") is not None:
+            info["profiles"].append(profile)
+
+
+# The profile of each invocation holds its cProfile stats, and the seconds
+# it spent decoding its input, importing, in SAVE and LOAD, and in total
+class RemoteStats(object):
+    """Profile stats from Lambda, in the form that pstats.Stats reads"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def merge_profiles(profiles):
+    """Combine the profiles of a map's invocations into one pstats.Stats"""
+    import pstats
+
+    stats = None
+    for profile in profiles:
+        if stats is None:
+            # Stats adopts the dict it's given and adds the others into it
+            stats = pstats.Stats(RemoteStats(dict(profile["stats"])))
+        else:
+            stats.add(RemoteStats(profile["stats"]))
+    return stats
+
+
+def report_profile(profiles, limit=20):
+    if not profiles:
+        eprint("No profiles were returned.")
+        return None
+
+    cold = sum(1 for profile in profiles if profile["cold"])
+    print(
+        "Profiled %d invocations (%d cold starts), in seconds:" % (len(profiles), cold)
     )
+    print("%-10s %10s %10s %10s" % ("", "total", "mean", "max"))
+    for name in ["total", "input", "imports", "load", "save", "exec"]:
+        times = [profile.get(name, 0) for profile in profiles]
+        print(
+            "%-10s %10.3f %10.3f %10.3f"
+            % (name, sum(times), sum(times) / len(times), max(times))
+        )
+
+    stats = merge_profiles(profiles)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return stats
 
-    known_aliases.add(info["alias"])
-    data = json.load(result["Payload"])
-    for line in base64.b64decode(result["LogResult"]).decode("utf-8").split("\n")[:-1]:
+
+def print_log(log, info):
+    for line in log.split("\n")[:-1]:
         is_aws = (
             line.startswith("START ")
             or line.startswith("END ")
@@ -630,8 +1291,12 @@ def invoke_thread(info):
             else:
                 print(line)
 
+
+def handle_response(data, lazy=False):
     if data is not None:
         if "result" in data:
+            if lazy and data["result"]["type"] == "s3":
+                return LazyResult(data["result"]["s3_key"], get_ctx().target)
             return decode_result(data["result"])
         elif "pretty" in data:
             return data["pretty"]
@@ -716,28 +1381,145 @@ def run_cell_magic(magic_name, line, cell):
 
 
 # Save to the designated Eigensheep S3 bucket. This is part of the public API.
-def save(key, data):
-    ctx = get_ctx()
-    ctx.s3Client.put_object(Bucket=ctx.bucket, Body=data, Key=key)
+def save(key, data, part_size=None, concurrency=None):
+    template.save(key, data, part_size=part_size, concurrency=concurrency)
 
 
 # Load from the designated Eigensheep S3 bucket. This is part of the public API.
-def load(key):
+# Whole objects are cached on disk by ETag, so loading an object again
+# after it has been downloaded once costs only a HEAD request. Objects
+# larger than a quarter of the cache are never cached.
+def load(
+    key,
+    start=None,
+    end=None,
+    stream=False,
+    part_size=None,
+    concurrency=None,
+    cache=True,
+):
+    options = {"part_size": part_size, "concurrency": concurrency}
+    if stream or start is not None or end is not None or not cache:
+        return template.load(key, start, end, stream=stream, **options)
+
     ctx = get_ctx()
-    res = ctx.s3Client.get_object(Bucket=ctx.bucket, Key=key)
-    return res["Body"].read()
+    name = hashlib.sha256((ctx.bucket + "/" + key).encode("utf-8")).hexdigest()
+    while True:
+        etag = ctx.s3Client.head_object(Bucket=ctx.bucket, Key=key)["ETag"]
+        path = os.path.join(CACHE_DIR, name + "." + etag.strip('"'))
+        if os.path.exists(path):
+            # the modification time of a cached object is when it was last
+            # used, and it may be removed by another thread at any moment
+            try:
+                os.utime(path, None)
+                with open(path, "rb") as f:
+                    return f.read()
+            except (IOError, OSError):
+                pass
+        try:
+            data = template.load(key, etag=etag, **options)
+            break
+        except ctx.s3Client.exceptions.ClientError as e:
+            # the object was replaced after the HEAD request, so start over
+            # rather than caching its new contents under the old ETag
+            if e.response.get("Error", {}).get("Code") != "PreconditionFailed":
+                raise
+
+    if len(data) > CACHE_SIZE // 4:
+        return data
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError:
+        pass
+    for other in os.listdir(CACHE_DIR):
+        if other.startswith(name + ".") and not other.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(CACHE_DIR, other))
+            except OSError:
+                pass
+    # write to a temporary file first so a partial download is never cached,
+    # with a name of its own for every thread loading the same object
+    temporary = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    with open(temporary, "wb") as f:
+        f.write(data)
+    try:
+        os.rename(temporary, path)
+    except OSError:
+        # another thread cached the same object first
+        os.remove(temporary)
+    trim_cache(CACHE_SIZE)
+    return data
+
+
+def trim_cache(limit):
+    """Remove the least recently used objects from the cache until the rest
+    of them take up no more than limit bytes"""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
 
 # This is part of the public API.
-def map(run_config, data=[0]):
+def map(
+    run_config,
+    data=[0],
+    fanout=None,
+    output_prefix=None,
+    options=None,
+    prewarm=None,
+    store=None,
+    lazy=False,
+    background=False,
+    priority=1,
+    stop_when=None,
+    profile=False,
+):
     ctx = get_ctx()
 
+    if background and (fanout or store is not None):
+        raise UsageError("Background jobs can't be combined with fanout or store")
+
+    if stop_when is not None and (fanout or store is not None):
+        raise UsageError("stop_when can't be combined with fanout or store")
+
+    if priority <= 0:
+        raise UsageError("The priority of a map has to be greater than zero")
+
+    if fanout is not None and fanout < 2:
+        raise UsageError("A fanout has to be at least 2")
+
     if isinstance(run_config, str):
         run_config = storedLambdas[run_config]
 
+    # containers are started while the tasks are being prepared
+    warming = None
+    if prewarm:
+        warming = executor.submit(warm_containers, run_config, prewarm)
+
     count = len(data)
     tasks = []
     box_config = run_config["box"]
+    job_id = uuid.uuid4().hex
+    cancel_key = "cancel/" + job_id
+    profiles = [] if profile else None
+    chunks = []
 
     for i, data in enumerate(data):
         payload = {
@@ -745,31 +1527,927 @@ def map(run_config, data=[0]):
             "code": run_config["code"],
             "index": i,
             "s3_bucket": ctx.bucket,
+            "cancel_key": cancel_key,
+            "job": job_id,
         }
 
         if "globals" in run_config:
             payload["globals"] = run_config["globals"]
 
+        if "bundle" in run_config:
+            payload["bundle"] = run_config["bundle"]
+
+        if output_prefix:
+            payload["output_key"] = output_prefix + str(i)
+
+        if fanout:
+            payload["result_key"] = "jobs/%s/results/%d" % (job_id, i)
+
+        if options:
+            payload.update(options)
+
+        if profile:
+            payload["profile"] = True
+
+        task = {
+            "alias": run_config["alias"],
+            "verbose": run_config.get("verbose", False),
+            "lazy": lazy,
+            "profiles": profiles,
+            "chunks": chunks,
+            # tasks which read or write keys of their own in the bucket
+            # have to run on the first target, which has those keys
+            "portable": not (options or output_prefix),
+            "payload": payload,
+        }
         if "python" in box_config["runtime"]:
-            payload["data"] = encode_result(data)
+            task["input"] = get_encoder().submit(template.pack_result, data)
+        tasks.append(task)
 
+    # launchers are sent every payload at once, so these are encoded
+    # up front, though still in parallel
+    if fanout:
+        payloads = list(executor.map(prepare_payload, tasks))
+
+    if warming is not None:
+        report_warm(warming.result(), prewarm)
+
+    if store is not None:
+        results = ResultStore(store, count)
+        # the index is written even when the map fails, so that the results
+        # which did arrive can still be read
+        try:
+            if fanout:
+                launch(
+                    run_config,
+                    payloads,
+                    fanout,
+                    results=results,
+                    profiles=profiles,
+                    chunks=chunks,
+                    priority=priority,
+                    cancel_key=cancel_key,
+                )
+            else:
+                job = scheduler.add(
+                    Job(
+                        tasks,
+                        priority,
+                        cancel_key,
+                        profiles=profiles,
+                        runner=store_thread,
+                    )
+                )
+
+                # results are written in the order that they arrive, so that
+                # each one can be dropped from memory as soon as it's written,
+                # and those which failed are left for job.result() to raise
+                def write(index):
+                    if job.results[index] is not None:
+                        results.write(index, job.results[index])
+                        job.results[index] = None
+
+                follow(job, write)
+                job.result()
+        finally:
+            results.finish()
+    elif fanout:
+        results = launch(
+            run_config,
+            payloads,
+            fanout,
+            lazy=lazy,
+            profiles=profiles,
+            chunks=chunks,
+            priority=priority,
+            cancel_key=cancel_key,
+        )
+    elif background:
+        return scheduler.add(Job(tasks, priority, cancel_key, stop_when, profiles))
+    elif count == 1:
+        job = scheduler.add(Job(tasks, priority, cancel_key, stop_when, profiles))
+        results = job.result()
+    else:
+        # maps in the foreground are scheduled along with background jobs,
+        # so that together they don't invoke more than MAX_CONCURRENCY
+        job = scheduler.add(Job(tasks, priority, cancel_key, stop_when, profiles))
+        follow(job)
+        results = job.result()
+
+    if fanout:
+        delete_keys([payload["result_key"] for payload in payloads])
+    release_job(job_id, chunks)
+    maybe_collect_garbage()
+    if profile:
+        report_profile(profiles)
+    return results
+
+
+# This is part of the public API.
+def submit(run_config, data=[0], priority=1, lazy=False, stop_when=None, profile=False):
+    """Start a map in the background and return a Job immediately. Jobs
+    share the available concurrency in proportion to their priority. The
+    inputs are encoded in the background while the first invocations run,
+    so they shouldn't be modified until the job is done."""
+    return map(
+        run_config,
+        data,
+        lazy=lazy,
+        background=True,
+        priority=priority,
+        stop_when=stop_when,
+        profile=profile,
+    )
+
+
+# This is part of the public API, as the return value of eigensheep.submit
+class Job(object):
+    """A map running in the background. If stop_when is given, the job is
+    cancelled as soon as it returns True for any result."""
+
+    def __init__(
+        self,
+        tasks,
+        priority=1,
+        cancel_key=None,
+        stop_when=None,
+        profiles=None,
+        runner=None,
+    ):
+        if priority <= 0:
+            raise UsageError("The priority of a job has to be greater than zero")
+        self.total = len(tasks)
+        self.pending = deque(enumerate(tasks))
+        self.results = [None] * self.total
+        self.finished = [False] * self.total
+        self.errors = []
+        self.completed = 0
+        self.running = 0
+        self.priority = float(priority)
+        self.cancelled = False
+        self.cancel_key = cancel_key
+        self.flagged = False
+        self.stop_when = stop_when
+        self.profiles = profiles
+        self.runner = runner or invoke_thread
+        # the index of each result as it arrives
+        self.arrived = deque()
+        self.done = threading.Event()
+        if not self.total:
+            self.done.set()
+
+    def progress(self):
+        """The number of finished invocations, and the total number"""
+        return self.completed, self.total
+
+    def partial(self):
+        """The results which have arrived so far, by index"""
+        return dict(
+            (i, result)
+            for i, (result, finished) in enumerate(zip(self.results, self.finished))
+            if finished
+        )
+
+    def cancel(self):
+        """Drop the invocations which haven't started yet, and stop waiting
+        for those which have. Cells which are still running can check
+        CANCELLED() to find out that they are no longer needed."""
+        scheduler.cancel(self)
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish, returning whether it has"""
+        return self.done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the job and return its results, where those which were
+        cancelled are None"""
+        if not self.wait(timeout):
+            raise Exception("Job did not finish within %s seconds" % timeout)
+        if self.errors:
+            raise self.errors[0]
+        # abandoned invocations may still finish after a job is cancelled
+        return list(self.results)
+
+    def profile(self, limit=20):
+        """Print the combined profile of the invocations which have finished,
+        if the job was started with profile=True, and return it as a
+        pstats.Stats"""
+        if self.profiles is None:
+            raise UsageError("This job wasn't started with profile=True")
+        return report_profile(list(self.profiles), limit)
+
+    def __repr__(self):
+        state = "cancelled" if self.cancelled else "running"
+        if self.done.is_set() and not self.cancelled:
+            state = "done"
+        return "<Job %s, %d of %d finished>" % (state, self.completed, self.total)
+
+
+class Scheduler(object):
+    """Dispatches the invocations of every job from one queue, so that no
+    more than the concurrency of each target run on it at once. Whenever a
+    slot is free, it goes to the job with the fewest running invocations
+    relative to its priority, which shares the concurrency fairly between
+    jobs, and each invocation goes to the target with the most free slots.
+    A launcher takes up a slot for every invocation in its tree, as given
+    by the cost of its task, or the whole target if that's more."""
+
+    def __init__(self):
+        self.running = 0
+        self.running_on = {}
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.dispatch)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+        return job
+
+    def cancel(self, job):
+        with self.condition:
+            if job.cancelled:
+                return
+            job.cancelled = True
+            job.pending.clear()
+            running = job.running
+            job.done.set()
+            self.condition.notify_all()
+        if running and job.cancel_key:
+            for_each_target(save, job.cancel_key, b"")
+            job.flagged = True
+
+    def place(self, task):
+        """The target with the most free slots which can run the task"""
+        best, most = None, 0
+        for target in get_targets():
+            if target is not get_targets()[0] and not task.get("portable"):
+                continue
+            free = target.concurrency - self.running_on.get(target.profile, 0)
+            if free > most and free >= task_cost(task, target):
+                best, most = target, free
+        return best
+
+    def choose(self):
+        """The fairest job whose next task can be placed, and its target"""
+        for job in sorted(self.jobs, key=lambda job: job.running / job.priority):
+            task = job.pending[0][1]
+            target = self.place(task)
+            if target is not None:
+                return job, target
+            if task.get("cost", 1) > 1:
+                # later jobs wait while a launcher does, otherwise they
+                # could keep taking the slots it needs as they're freed
+                break
+        return None, None
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while True:
+                    self.jobs = [job for job in self.jobs if job.pending]
+                    job, target = self.choose()
+                    if job is not None:
+                        break
+                    self.condition.wait()
+                index, task = job.pending.popleft()
+                cost = task_cost(task, target)
+                if target is not get_targets()[0]:
+                    task = dict(task, target=target)
+                job.running += cost
+                self.running += cost
+                self.running_on[target.profile] = (
+                    self.running_on.get(target.profile, 0) + cost
+                )
+            executor.submit(self.invoke, job, index, task, target, cost)
+
+    def invoke(self, job, index, task, target, cost):
+        error = None
+        try:
+            result = job.runner(task)
+        except Exception as e:
+            result, error = None, e
+        with self.condition:
+            job.results[index] = result
+            job.finished[index] = True
+            job.arrived.append(index)
+            if error is not None:
+                job.errors.append(error)
+            job.completed += 1
+            job.running -= cost
+            self.running -= cost
+            self.running_on[target.profile] -= cost
+            if job.running == 0 and not job.pending:
+                job.done.set()
+            self.condition.notify_all()
+
+        if job.running == 0 and job.flagged:
+            for_each_target(delete_keys, [job.cancel_key])
+        elif job.stop_when is not None and error is None and not job.cancelled:
+            if job.stop_when(result):
+                self.cancel(job)
+
+
+scheduler = Scheduler()
+
+
+def task_cost(task, target):
+    return min(task.get("cost", 1), target.concurrency)
+
+
+def follow(job, on_result=None):
+    """Show the progress of a job until it's done, passing the index of each
+    result to on_result as it arrives. Interrupting it cancels the job."""
+
+    def drain():
+        while on_result is not None and job.arrived:
+            on_result(job.arrived.popleft())
+
+    progress = tqdm(total=job.total)
+    try:
+        while not job.wait(0.1):
+            drain()
+            progress.update(job.completed - progress.n)
+    except KeyboardInterrupt:
+        job.cancel()
+        eprint("Interrupted, keeping the results which have arrived.")
+    drain()
+    progress.update(job.completed - progress.n)
+    progress.close()
+
+
+# Results headed for a ResultStore are kept compressed and pickled,
+# rather than being unpickled only to be pickled again
+def store_thread(info):
+    with use_target(info.get("target")):
+        data = invoke_raw(info)
+        if isinstance(data, dict) and "result" in data:
+            result = data["result"]
+            while result["type"] == "s3":
+                result = json.loads(load(result["s3_key"], cache=False))
+            if result["type"] == "b64+zlib+pickle":
+                return base64.b64decode(result["data"])
+        return zlib.compress(pickle.dumps(handle_response(data), 2))
+
+
+# Rather than sending every invocation from the notebook, send a handful
+# of LAUNCH events which invoke the tasks (or further launchers) from
+# inside Lambda. Launchers have the same timeout as their tasks, so they
+# only wait on them until just before they would time out, and each task
+# also saves its response at its result_key for when that happens.
+def launch(
+    run_config,
+    payloads,
+    fanout,
+    results=None,
+    lazy=False,
+    profiles=None,
+    chunks=None,
+    priority=1,
+    cancel_key=None,
+):
+    ctx = get_ctx()
+    # there are at least enough launchers that each one's tree fits in
+    # the concurrency of the target, so that they can all be scheduled
+    size = launch_size(fanout, get_targets()[0].concurrency)
+    groups = max(fanout, (len(payloads) + size - 1) // size)
+    tasks = []
+    for group in split_evenly(payloads, groups):
+        payload = {
+            "type": "LAUNCH",
+            "fanout": fanout,
+            "s3_bucket": ctx.bucket,
+            "tasks": encode_result(group),
+        }
         tasks.append(
             {
                 "alias": run_config["alias"],
                 "verbose": run_config.get("verbose", False),
+                "count": len(group),
+                "cost": launch_cost(len(group), fanout),
+                "timeout": run_config["box"].get("timeout", DEFAULT_TIMEOUT),
+                "lazy": lazy,
+                "profiles": profiles,
+                "chunks": chunks,
                 "payload": json.dumps(payload),
             }
         )
 
-    if count == 1:
-        return [invoke_thread(tasks[0])]
+    # launchers which already started can't be recalled when the job is
+    # cancelled, but the cells they invoked can find out through the flag
+    job = scheduler.add(Job(tasks, priority, cancel_key, runner=launch_thread))
+    follow(job)
+    if results is None:
+        results = []
+    for task, group in zip(tasks, job.result()):
+        if group is not None:
+            results.extend(group)
+        elif isinstance(results, ResultStore):
+            # leave the missing results unwritten, without shifting the rest
+            results.appended += task["count"]
+        else:
+            results.extend([None] * task["count"])
+    return results
+
+
+def launch_cost(count, fanout):
+    """The number of invocations running at once in the tree of a launcher
+    with count tasks, including the launcher and any sub-launchers"""
+    fanout = min(fanout, template.MAX_FANOUT)
+    if count <= fanout:
+        return 1 + count
+    size, extra = divmod(count, fanout)
+    return (
+        1
+        + extra * launch_cost(size + 1, fanout)
+        + (fanout - extra) * launch_cost(size, fanout)
+    )
+
+
+def launch_size(fanout, limit):
+    """The most tasks a launcher can have without its tree being more than
+    limit invocations, or 1 if even that is too many"""
+    low, high = 1, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if launch_cost(middle, fanout) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+# This is part of the public API, as part of the return value of map(..., lazy=True)
+class LazyResult(object):
+    """A handle to a result which was too large to be sent back directly and
+    was saved to S3 instead. It's only downloaded and decoded when get() is
+    first called, unless it was prefetched in the background beforehand."""
+
+    def __init__(self, s3_key, target=None):
+        self.s3_key = s3_key
+        self.target = target
+        self.lock = threading.Lock()
+        self.future = None
+        self.loaded = False
+        self.value = None
+
+    def prefetch(self):
+        with self.lock:
+            if self.future is None and not self.loaded:
+                self.future = get_downloader().submit(
+                    load_from, self.target, self.s3_key
+                )
+        return self
+
+    def get(self):
+        with self.lock:
+            if not self.loaded:
+                if self.future is not None:
+                    contents = self.future.result()
+                else:
+                    contents = load_from(self.target, self.s3_key)
+                self.value = decode_result(json.loads(contents))
+                self.loaded = True
+                self.future = None
+        return self.value
+
+    def __repr__(self):
+        return "<LazyResult %s%s>" % (self.s3_key, " (loaded)" if self.loaded else "")
+
+
+# Lazy results are downloaded by their own small pool of threads,
+# rather than the pool which waits on invocations
+def get_downloader():
+    global downloader
+    if downloader is None:
+        downloader = ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY)
+    return downloader
+
+
+def load_from(target, key):
+    with use_target(target):
+        return load(key, cache=False)
+
+
+# This is part of the public API.
+def prefetch(results):
+    """Start downloading every lazy result in a list in the background"""
+    for result in results:
+        if isinstance(result, LazyResult):
+            result.prefetch()
+    return results
+
+
+# This is part of the public API.
+def resolve(results):
+    """Replace every lazy result in a list with its value, downloading
+    them in parallel"""
+    return [
+        result.get() if isinstance(result, LazyResult) else result
+        for result in prefetch(results)
+    ]
+
+
+# This is part of the public API, as the return value of map(..., store=path)
+class ResultStore(object):
+    """A read-only list of results kept in a file on disk, where each result
+    is only unpickled when it is accessed. The file holds the compressed
+    pickle of every result, and a second file holds where each one is, as
+    the offsets and then the lengths in little-endian 64-bit integers."""
+
+    def __init__(self, path, count=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.view = None
+        if count is None:
+            # open the results of an earlier map
+            with open(path + ".index", "rb") as f:
+                packed = f.read()
+            count = len(packed) // 16
+            index = struct.unpack("<%dq" % (2 * count), packed)
+            self.offsets, self.lengths = list(index[:count]), list(index[count:])
+            self.map_file()
+        else:
+            self.offsets = [0] * count
+            self.lengths = [-1] * count
+            self.appended = 0
+            self.file = open(path, "wb")
+
+    def write(self, index, blob):
+        with self.lock:
+            self.offsets[index] = self.file.tell()
+            self.lengths[index] = len(blob)
+            self.file.write(blob)
+
+    def extend(self, values):
+        for value in values:
+            self.write(self.appended, zlib.compress(pickle.dumps(value, 2)))
+            self.appended += 1
+
+    def finish(self):
+        self.file.close()
+        with open(self.path + ".index", "wb") as f:
+            index = self.offsets + self.lengths
+            f.write(struct.pack("<%dq" % len(index), *index))
+        self.map_file()
+        return self
+
+    def map_file(self):
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("result index out of range")
+        offset, length = self.offsets[index], self.lengths[index]
+        if length < 0:
+            raise KeyError("result %d never arrived" % index)
+        return pickle.loads(zlib.decompress(self.view[offset : offset + length]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "<ResultStore of %d results in %r>" % (len(self), self.path)
+
+    def to_numpy(self):
+        """Stack the results, which should all be arrays of the same shape,
+        into one array filled in one result at a time"""
+        import numpy
+
+        first = numpy.asarray(self[0])
+        stacked = numpy.empty((len(self),) + first.shape, dtype=first.dtype)
+        for i, value in enumerate(self):
+            stacked[i] = value
+        return stacked
+
+    def to_dataframe(self):
+        """Concatenate results which are DataFrames, or otherwise make a
+        DataFrame with one row for each result"""
+        import pandas
+
+        if len(self) and isinstance(self[0], pandas.DataFrame):
+            return pandas.concat(iter(self), ignore_index=True)
+        return pandas.DataFrame.from_records(iter(self), nrows=len(self))
+
+
+# This is part of the public API.
+def prewarm(run_config, n, hold=1.0):
+    """Start n containers for a cell ahead of a large map, so that its first
+    invocations don't pay for a cold start. Returns the number of distinct
+    containers which responded."""
+    if isinstance(run_config, str):
+        run_config = storedLambdas[run_config]
+    warm = warm_containers(run_config, n, hold)
+    report_warm(warm, n)
+    return warm
+
+
+def warm_containers(run_config, n, hold=1.0):
+    ctx = get_ctx()
+    payload = {"type": "WARM", "hold": hold, "s3_bucket": ctx.bucket}
+    if "bundle" in run_config:
+        payload["bundle"] = run_config["bundle"]
+    task = {
+        "alias": run_config["alias"],
+        "verbose": False,
+        "redirectStdout": True,
+        "payload": json.dumps(payload),
+    }
+    # each container writes to its own log stream
+    machines = set(
+        result["machine"]
+        for result in scheduler.add(Job([task] * n)).result()
+        if isinstance(result, dict) and "machine" in result
+    )
+    return len(machines)
+
+
+def report_warm(warm, n):
+    eprint("%d of %d containers are warm." % (warm, n))
+
+
+# This is part of the public API.
+def map_s3(
+    run_config, prefix="", split_bytes=64 * 1024 * 1024, delimiter="\n", fanout=None
+):
+    """Map over the objects under a prefix of the eigensheep bucket without
+    downloading them to the notebook. Objects are split into ranges of about
+    split_bytes, and each task streams its range from S3 and is given an
+    iterator over the delimited records which begin in it as DATA, or the
+    raw bytes of the range as a file-like object if the delimiter is None."""
+    ctx = get_ctx()
+    ranges = []
+    paginator = ctx.s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=ctx.bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            size = obj["Size"]
+            for start in range(0, size, split_bytes):
+                end = min(start + split_bytes, size)
+                ranges.append([obj["Key"], start, end, size])
+
+    options = {"records": {"delimiter": delimiter}}
+    return map(run_config, ranges, fanout=fanout, options=options)
+
+
+# This is part of the public API.
+def map_reduce(run_config, data, reducer, fanin=10):
+    """Map over data and combine the results inside Lambda in a tree where
+    each reducer invocation combines up to `fanin` values, so that only the
+    final value is sent back to the notebook. The reducer is either the name
+    of a stored cell or a string of code, which is run with the list of
+    values to combine as VALUES. The values it receives may be results of
+    the map or of other reducers, so they should be of the same kind."""
+    ctx = get_ctx()
+
+    if not len(data):
+        raise UsageError("map_reduce needs at least one value to map over")
+
+    if fanin < 2:
+        raise UsageError("A fanin has to be at least 2")
+
+    if isinstance(run_config, str):
+        run_config = storedLambdas[run_config]
+
+    if reducer in storedLambdas:
+        reduce_config = storedLambdas[reducer]
     else:
-        return list(tqdm(executor.map(invoke_thread, tasks), total=count))
+        reduce_config = dict(run_config, code=reducer)
+
+    prefix = "jobs/%s/" % uuid.uuid4().hex
+    keys = check_keys(map(run_config, data, output_prefix=prefix + "0/"))
+    written = list(keys)
+
+    level = 1
+    while len(keys) > 1:
+        tasks = []
+        for i in range(0, len(keys), fanin):
+            payload = {
+                "type": "REDUCE",
+                "code": reduce_config["code"],
+                "inputs": keys[i : i + fanin],
+                "output_key": "%s%d/%d" % (prefix, level, i // fanin),
+                "s3_bucket": ctx.bucket,
+            }
+            if "globals" in reduce_config:
+                payload["globals"] = reduce_config["globals"]
+            if "bundle" in reduce_config:
+                payload["bundle"] = reduce_config["bundle"]
+            tasks.append(
+                {
+                    "alias": reduce_config["alias"],
+                    "verbose": reduce_config.get("verbose", False),
+                    "payload": json.dumps(payload),
+                }
+            )
+        job = scheduler.add(Job(tasks))
+        follow(job)
+        keys = check_keys(job.result())
+        written.extend(keys)
+        level += 1
+
+    result = decode_result(json.loads(load(keys[0])))
+    delete_keys(written)
+    return result
+
+
+# This is part of the public API.
+def shuffle(map_config, data, reduce_config, partitions=10, combiner=None):
+    """Run a two stage job where the first stage regroups its output by key
+    without passing through the notebook. Cells in the first stage call
+    EMIT(key, value), and each of the `partitions` tasks of the second stage
+    is given a dict of the values emitted for its keys as DATA. The combiner
+    is an optional expression of KEY and VALUES that each mapper uses to
+    merge the values it emitted for a key before they are saved."""
+    if isinstance(map_config, str):
+        map_config = storedLambdas[map_config]
+    if isinstance(reduce_config, str):
+        reduce_config = storedLambdas[reduce_config]
+
+    options = {
+        "shuffle": {
+            "prefix": "jobs/%s/" % uuid.uuid4().hex,
+            "partitions": partitions,
+            "combiner": combiner,
+        }
+    }
+    written = map(map_config, data, options=options)
+    for result in written:
+        if not isinstance(result, dict) or "offsets" not in result:
+            eprint(result)
+            raise Exception("A mapper failed during the shuffle")
+
+    inputs = [[] for _ in range(partitions)]
+    sizes = [0] * partitions
+    for result in written:
+        for p, (start, end) in enumerate(result["offsets"]):
+            if end > start:
+                inputs[p].append([result["key"], start, end])
+                sizes[p] += end - start
+    report_partition_sizes(sizes)
+
+    results = map(reduce_config, inputs, options={"gather": True})
+    delete_keys([result["key"] for result in written])
+    return results
+
+
+def report_partition_sizes(sizes):
+    mean = float(sum(sizes)) / len(sizes)
+    skew = max(sizes) / mean if mean else 0
+    eprint(
+        "Shuffled %d bytes into %d partitions: smallest %d, largest %d (%.1fx mean)."
+        % (sum(sizes), len(sizes), min(sizes), max(sizes), skew)
+    )
+
+
+def check_keys(results):
+    keys = []
+    for result in results:
+        if result is None:
+            raise Exception("The reduction was interrupted")
+        if isinstance(result, dict):
+            eprint(result)
+            raise Exception(result.get("errorMessage", "Reduction failed"))
+        keys.append(result)
+    return keys
+
+
+def delete_keys(keys):
+    ctx = get_ctx()
+    # delete_objects accepts at most 1000 keys per request
+    for i in range(0, len(keys), 1000):
+        ctx.s3Client.delete_objects(
+            Bucket=ctx.bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+        )
+
+
+def list_objects(prefix):
+    ctx = get_ctx()
+    paginator = ctx.s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=ctx.bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj
+
+
+# Large inputs and results are saved as chunks named by their contents, so
+# any number of jobs can share one. Each job that uses a chunk writes a
+# reference to it as an empty object at refs/jobs/<job>/<chunk>, which is
+# deleted when the job's results have been downloaded, and each alias that
+# uses a bundle writes one at refs/aliases/<alias>/<bundle>. Garbage
+# collection removes whatever is no longer referenced.
+def release_job(job_id, chunks):
+    if chunks:
+        refs = ["refs/jobs/%s/%s" % (job_id, key) for key in set(chunks)]
+        for_each_target(delete_keys, refs)
+
+
+# This is part of the public API.
+def collect_garbage(grace=GC_GRACE, max_age=REF_MAX_AGE):
+    """Remove the chunks and bundles which no job or alias references, the
+    references of jobs older than max_age (in seconds) and of aliases which
+    no longer exist, and packages and flags left behind by deployments and
+    maps which didn't finish. Nothing newer than grace seconds is removed."""
+    removed = for_each_target(collect_target_garbage, grace, max_age)
+    staged_objects.clear()
+    uploaded_bundles.clear()
+    if not os.path.isdir(os.path.dirname(GC_MARKER)):
+        os.makedirs(os.path.dirname(GC_MARKER))
+    with open(GC_MARKER, "w"):
+        pass
+    eprint(
+        "Removed %d objects (%.1fMB)."
+        % (
+            sum(count for count, size in removed),
+            sum(size for count, size in removed) / 1e6,
+        )
+    )
+
+
+def collect_target_garbage(grace, max_age):
+    ctx = get_ctx()
+    now = time.time()
+
+    def age(obj):
+        return now - calendar.timegm(obj["LastModified"].utctimetuple())
+
+    aliases = set()
+    kwargs = {"FunctionName": ctx.functionName}
+    while True:
+        page = ctx.lambdaClient.list_aliases(**kwargs)
+        aliases.update(ali["Name"] for ali in page["Aliases"])
+        if not page.get("NextMarker"):
+            break
+        kwargs["Marker"] = page["NextMarker"]
+
+    def references():
+        stale, referenced = [], set()
+        for obj in list_objects("refs/"):
+            kind, owner, key = obj["Key"].split("/", 3)[1:]
+            if kind == "jobs" and age(obj) > max_age:
+                stale.append(obj)
+            elif kind == "aliases" and owner not in aliases:
+                stale.append(obj)
+            else:
+                referenced.add(key)
+        return stale, referenced
+
+    garbage, referenced = references()
+    for prefix, min_age in [
+        ("chunks/", grace),
+        ("bundles/", grace),
+        ("builds/", grace),
+        ("cancel/", grace),
+        ("jobs/", max_age),
+        ("lambda_package.zip", grace),
+    ]:
+        for obj in list_objects(prefix):
+            if obj["Key"] not in referenced and age(obj) > min_age:
+                garbage.append(obj)
+
+    # a job which reuses an old object references it and then resets its
+    # modification time, either of which may have happened after they were
+    # listed above, so the references are checked again just before deleting
+    referenced = references()[1]
+    garbage = [obj for obj in garbage if obj["Key"] not in referenced]
+    delete_keys([obj["Key"] for obj in garbage])
+    return len(garbage), sum(obj.get("Size", 0) for obj in garbage)
+
+
+def maybe_collect_garbage():
+    """Collect garbage in the background after a map, if it hasn't been
+    done in the last eigensheep_gc_interval hours, when that's set in the
+    eigensheep profile"""
+    interval = get_option(AWS_PROFILE, "eigensheep_gc_interval")
+    if interval is None:
+        return
+    if os.path.exists(GC_MARKER):
+        if time.time() - os.path.getmtime(GC_MARKER) < float(interval) * 60 * 60:
+            return
+    if not os.path.isdir(os.path.dirname(GC_MARKER)):
+        os.makedirs(os.path.dirname(GC_MARKER))
+    with open(GC_MARKER, "w"):
+        pass
+    executor.submit(collect_garbage)
 
 
 # This is part of the public API.
-def invoke(run_config, data=0):
-    return map(run_config, [data])[0]
+def invoke(run_config, data=0, profile=False):
+    return map(run_config, [data], profile=profile)[0]
 
 
 try:
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os, sys, ast, pprint, pickle, base64, zlib, hashlib
+import os, sys, ast, pprint, pickle, base64, zlib, hashlib, json, time
 
 # TODO: consider using https://github.com/ipython/ipython/blob/
 #                      master/IPython/core/interactiveshell.py
@@ -14,22 +14,182 @@ def get_ctx():
     raise NotImplementedError()
 
 
-def save(key, data):
-    ctx = get_ctx()
-    ctx.s3Client.put_object(Bucket=ctx.bucket, Body=data, Key=key)
+# Objects larger than a part are transferred as several parts in parallel.
+# Every part of a multipart upload except the last must be at least 5MB.
+PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+TRANSFER_CONCURRENCY = 8
 
 
-def load(key):
+def save(key, data, part_size=None, concurrency=None):
+    """Save bytes, a string, a file-like object or an iterator of bytes,
+    using a parallel multipart upload if it is larger than one part"""
+    # the context in the notebook is thread local, so the client is
+    # taken from it here rather than in the threads uploading parts
+    ctx = get_ctx()
+    s3Client, bucket = ctx.s3Client, ctx.bucket
+    part_size = max(part_size or PART_SIZE, MIN_PART_SIZE)
+    concurrency = concurrency or TRANSFER_CONCURRENCY
+
+    parts = iter_parts(data, part_size)
+    first = next(parts)
+    second = next(parts, None)
+    if second is None:
+        s3Client.put_object(Bucket=bucket, Body=first, Key=key)
+        return
+
+    upload_id = s3Client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def upload(part):
+        number, body = part
+        res = s3Client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        return {"ETag": res["ETag"], "PartNumber": number}
+
+    try:
+        # parts are read in batches so that at most `concurrency`
+        # of them are held in memory when saving a stream
+        completed = []
+        batch = [(1, first), (2, second)]
+        for number, part in enumerate(parts, 3):
+            if len(batch) >= concurrency:
+                completed.extend(parallel_map(upload, batch, concurrency))
+                batch = []
+            batch.append((number, part))
+        completed.extend(parallel_map(upload, batch, concurrency))
+
+        s3Client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": completed},
+        )
+    except Exception:
+        s3Client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def iter_parts(data, part_size):
+    """Split data into parts of part_size bytes, where the last part may be
+    smaller. There is always at least one part, even if it's empty."""
+    if not isinstance(data, bytes) and hasattr(data, "encode"):
+        data = data.encode("utf-8")
+
+    if isinstance(data, (bytes, bytearray)):
+        for i in range(0, max(len(data), 1), part_size):
+            yield data[i : i + part_size]
+        return
+
+    if hasattr(data, "read"):
+        data = read_chunks(data, part_size)
+
+    buffered = []
+    length = 0
+    for chunk in data:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode("utf-8")
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= part_size:
+            joined = b"".join(buffered)
+            while len(joined) >= part_size:
+                yield joined[:part_size]
+                joined = joined[part_size:]
+            buffered = [joined]
+            length = len(joined)
+    yield b"".join(buffered)
+
+
+def read_chunks(fileobj, size):
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def load(
+    key,
+    start=None,
+    end=None,
+    stream=False,
+    part_size=None,
+    concurrency=None,
+    etag=None,
+):
+    """Load an object, or the half-open byte range [start, end) of it. With
+    stream=True a file-like object which reads the body as it arrives is
+    returned, otherwise anything larger than a part is downloaded as
+    several ranges in parallel. If an ETag is given, the load fails unless
+    the object still has that ETag."""
     ctx = get_ctx()
-    res = ctx.s3Client.get_object(Bucket=ctx.bucket, Key=key)
-    return res["Body"].read()
+    s3Client, bucket = ctx.s3Client, ctx.bucket
+    match = {} if etag is None else {"IfMatch": etag}
+    if stream:
+        if start is None and end is None:
+            res = s3Client.get_object(Bucket=bucket, Key=key)
+        else:
+            res = s3Client.get_object(
+                Bucket=bucket, Key=key, Range=byte_range(start, end)
+            )
+        return res["Body"]
+
+    part_size = part_size or PART_SIZE
+    concurrency = concurrency or TRANSFER_CONCURRENCY
+
+    begin = start or 0
+    first_end = begin + part_size if end is None else min(end, begin + part_size)
+    if first_end <= begin:
+        return b""
+    try:
+        res = s3Client.get_object(
+            Bucket=bucket, Key=key, Range=byte_range(begin, first_end), **match
+        )
+    except s3Client.exceptions.ClientError as e:
+        # this is what S3 says when asked for the first part of an empty object
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return b""
+        raise
+    first = res["Body"].read()
+    if "ContentRange" not in res:
+        return first
+
+    total = int(res["ContentRange"].split("/")[-1])
+    stop = total if end is None else min(end, total)
+    rest = [(p, min(p + part_size, stop)) for p in range(first_end, stop, part_size)]
+
+    def download(r):
+        # IfMatch makes sure that every part is from the same version
+        return s3Client.get_object(
+            Bucket=bucket, Key=key, Range=byte_range(*r), IfMatch=res["ETag"]
+        )["Body"].read()
+
+    return b"".join([first] + parallel_map(download, rest, concurrency))
+
+
+def byte_range(start, end):
+    """Format the HTTP Range header for the half-open interval [start, end)"""
+    return "bytes=%d-%s" % (start or 0, "" if end is None else end - 1)
 
 
 def lambda_handler(event, context):
     global get_ctx
 
+    # the clients are created once per event and then shared, because
+    # creating boto3 clients from several threads at once isn't safe
+    cached = []
+
     def get_ctx_impl():
+        if cached:
+            return cached[0]
+
         import boto3
+        from botocore.config import Config
 
         class Context:
             pass
@@ -37,13 +197,28 @@ def lambda_handler(event, context):
         ctx = Context()
 
         ctx.s3Client = boto3.client("s3")
+        ctx.lambdaClient = boto3.client(
+            "lambda",
+            config=Config(read_timeout=900, max_pool_connections=MAX_FANOUT),
+        )
         ctx.bucket = event["s3_bucket"]
+        # chunks written for a job are referenced by it until it's done
+        ctx.owner = "jobs/" + event["job"] if "job" in event else None
+        cached.append(ctx)
         return ctx
 
     get_ctx = get_ctx_impl
 
-    if event["type"] == "RUN":
+    if event["type"] == "RUN" and "result_key" in event:
+        return lambda_run_saved(event, context)
+    elif event["type"] == "RUN":
         return lambda_run(event, context)
+    elif event["type"] == "LAUNCH":
+        return lambda_launch(event, context)
+    elif event["type"] == "REDUCE":
+        return lambda_reduce(event, context)
+    elif event["type"] == "WARM":
+        return lambda_warm(event, context)
     elif event["type"] == "BUILD":
         return lambda_build(event, context)
 
@@ -74,9 +249,175 @@ def lambda_build(event, context):
         + event["requirements"]
     )
 
+    report = {}
+    if event.get("optimize", True):
+        report = optimize_package(
+            path, event["requirements"], DEFAULT_PRUNE + event.get("prune", [])
+        )
+
     package = build_lambda_package(path)
+    report["zip_size"] = len(package)
     save(event["s3_key"], package)
-    return {}
+    return {"report": report}
+
+
+# Files matching these patterns (relative to the dependency directory, with
+# a leading slash) aren't needed to import anything and are left out
+DEFAULT_PRUNE = [
+    "*/tests/*",
+    "*/test/*",
+    "*/docs/*",
+    "*/doc/*",
+    "*/examples/*",
+    "*/__pycache__/*",
+    "*.pyc",
+    "*.pyi",
+    "*.pyx",
+    "*.pxd",
+    "*.c",
+    "*.h",
+    "*.dist-info/RECORD",
+    "*.dist-info/INSTALLER",
+    "*.dist-info/WHEEL",
+    "*.dist-info/LICENSE*",
+]
+
+# The Lambda runtime already includes these, but pip installs them again
+# as dependencies, so they're removed unless they were asked for
+RUNTIME_PROVIDED = ["boto3", "botocore", "s3transfer", "jmespath"]
+
+# Sources are given this modification time before they're compiled on
+# Python 2, which has no hash-based bytecode. It's on an even second so
+# that it survives being zipped (2010-01-01 UTC).
+PACKAGE_MTIME = 1262304000
+
+
+def optimize_package(path, requirements, prune):
+    """Slim down the installed dependencies before they're zipped, to
+    reduce cold start time and stay under the package size limit, and
+    report the size and import time before and after"""
+    import fnmatch
+    import shutil
+    import compileall
+    import py_compile
+    import subprocess
+
+    modules = top_level_modules(path, requirements)
+    report = {
+        "size_before": directory_size(path),
+        "import_before": time_imports(path, modules),
+    }
+
+    requested = set(requirement_name(req) for req in requirements)
+    for name in os.listdir(path):
+        base = requirement_name(name.split("-")[0])
+        if base in RUNTIME_PROVIDED and base not in requested:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        for file in files:
+            full = os.path.join(root, file)
+            relative = "/" + os.path.relpath(full, path).replace(os.sep, "/")
+            if any(fnmatch.fnmatch(relative, pattern) for pattern in prune):
+                os.remove(full)
+        if root != path and not os.listdir(root):
+            os.rmdir(root)
+
+    strip = find_executable("strip")
+    if strip:
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                if file.endswith(".so") or ".so." in file:
+                    subprocess.call(
+                        [strip, "--strip-unneeded", os.path.join(root, file)]
+                    )
+
+    # the build runs on the same runtime as the package, so the bytecode
+    # compiled here can be used as is when the package is imported. Zip
+    # files only keep modification times to the even second, so bytecode
+    # which is checked against the source's time would be stale as soon as
+    # it's unzipped, and recompiled (without being saved) on every cold start
+    if hasattr(py_compile, "PycInvalidationMode"):
+        compileall.compile_dir(
+            path,
+            quiet=1,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    else:
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                if file.endswith(".py"):
+                    os.utime(os.path.join(root, file), (PACKAGE_MTIME, PACKAGE_MTIME))
+        compileall.compile_dir(path, quiet=1)
+
+    report["size_after"] = directory_size(path)
+    report["import_after"] = time_imports(path, modules)
+    report["stripped"] = bool(strip)
+    return report
+
+
+def requirement_name(requirement):
+    import re
+
+    return re.split("[<>=!~;\\[ ]", requirement.strip())[0].lower().replace("-", "_")
+
+
+def top_level_modules(path, requirements):
+    """Find the names of the modules installed by the requested packages"""
+    modules = []
+    requested = set(requirement_name(req) for req in requirements)
+    for name in os.listdir(path):
+        if not name.endswith(".dist-info"):
+            continue
+        if requirement_name(name.split("-")[0]) not in requested:
+            continue
+        top_level = os.path.join(path, name, "top_level.txt")
+        if os.path.exists(top_level):
+            with open(top_level, "r") as f:
+                modules.extend(line.strip() for line in f if line.strip())
+        else:
+            modules.append(requirement_name(name.split("-")[0]))
+    return modules
+
+
+def time_imports(path, modules):
+    """Measure how long importing the modules takes in a new interpreter"""
+    import subprocess
+
+    code = "\n".join(
+        [
+            "import sys, time",
+            "sys.path.insert(0, %r)" % path,
+            "start = time.time()",
+            "for name in %r:" % modules,
+            "    try:",
+            "        __import__(name)",
+            "    except Exception:",
+            "        pass",
+            "print(time.time() - start)",
+        ]
+    )
+    try:
+        output = subprocess.check_output([sys.executable, "-c", code])
+        return float(output.decode("utf-8").strip().split()[-1])
+    except (subprocess.CalledProcessError, ValueError, IndexError):
+        return None
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, dirs, files in os.walk(path)
+        for file in files
+    )
+
+
+def find_executable(name):
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    return which(name)
 
 
 def zipdir(ziph, path, realpath):
@@ -113,34 +454,490 @@ def build_lambda_package(dep_path):
 
 
 def lambda_run(event, context):
+    global warm
+    started = time.time()
+    data = decode_result(event["data"])
+    if event.get("gather"):
+        data = gather_partition(data)
+    elif "records" in event:
+        data = read_range(data, event["records"]["delimiter"])
+    loaded = time.time()
+
     globalenv = {
         "INDEX": event["index"],
-        "DATA": decode_result(event["data"]),
+        "DATA": data,
         "BUCKET": event["s3_bucket"],
         "SAVE": save,
         "LOAD": load,
     }
+
+    partitions = None
+    if "shuffle" in event:
+        partitions = [{} for _ in range(event["shuffle"]["partitions"])]
+
+        def emit(key, value):
+            part = partitions[stable_hash(key) % len(partitions)]
+            part.setdefault(key, []).append(value)
+
+        globalenv["EMIT"] = emit
+
+    if "cancel_key" in event:
+        globalenv["CANCELLED"] = cancel_checker(event["cancel_key"])
+
     if "globals" in event:
         for key in event["globals"]:
             globalenv[key] = event["globals"][key]
-    result = my_exec(event["code"], globalenv, globalenv)
+    profile = None
+    if event.get("profile"):
+        profile = {"cold": not warm, "input": loaded - started}
+        globalenv["SAVE"] = timed(save, profile, "save")
+        globalenv["LOAD"] = timed(load, profile, "load")
+    warm = True
+
+    if "bundle" in event:
+        use_bundle(event["bundle"], globalenv)
+    if profile is not None:
+        result = profile_exec(event["code"], globalenv, profile)
+    else:
+        result = my_exec(event["code"], globalenv, globalenv)
+
+    # the values emitted by a shuffle mapper replace its result
+    if partitions is not None:
+        result = write_partitions(event["shuffle"], event["index"], partitions)
+
+    # results destined for a reduction are left in the bucket
+    # and only the key where they can be found is returned
+    if "output_key" in event:
+        save(event["output_key"], json.dumps(encode_result(result)))
+        result = event["output_key"]
 
     output = {
         "machine": os.environ["AWS_LAMBDA_LOG_STREAM_NAME"],
         "result": encode_result(result),
     }
+    if profile is not None:
+        profile["total"] = time.time() - started
+        output["profile"] = encode_result(profile)
 
     return output
 
 
+def lambda_run_saved(event, context):
+    """Run a task started by a launcher, and also save its response where
+    the notebook can find it if the launcher times out before it's done"""
+    try:
+        output = lambda_run(event, context)
+    except Exception as e:
+        import traceback
+
+        output = {
+            "errorMessage": str(e),
+            "errorType": type(e).__name__,
+            "stackTrace": traceback.format_exc().split("\n"),
+        }
+        save(event["result_key"], json.dumps(output))
+        raise
+    save(event["result_key"], json.dumps(output))
+    return output
+
+
+# Whether this container has handled a RUN before, so that profiles can
+# tell whether an invocation was the first one in a new container
+warm = False
+
+
+def timed(fn, profile, name):
+    """Wrap a function so that the time spent in it is added to the profile"""
+    profile[name] = 0.0
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile[name] += time.time() - start
+
+    return wrapper
+
+
+def profile_exec(code, globalenv, profile):
+    """Run the cell under cProfile, and time the imports it does separately,
+    counting only the outermost import of each chain of nested imports"""
+    import cProfile
+
+    try:
+        import builtins
+    except ImportError:
+        import __builtin__ as builtins
+
+    original_import = builtins.__import__
+    depth = [0]
+    profile["imports"] = 0.0
+
+    def timed_import(*args, **kwargs):
+        if depth[0]:
+            return original_import(*args, **kwargs)
+        depth[0] += 1
+        start = time.time()
+        try:
+            return original_import(*args, **kwargs)
+        finally:
+            depth[0] -= 1
+            profile["imports"] += time.time() - start
+
+    profiler = cProfile.Profile()
+    start = time.time()
+    builtins.__import__ = timed_import
+    try:
+        return profiler.runcall(my_exec, code, globalenv, globalenv)
+    finally:
+        builtins.__import__ = original_import
+        profile["exec"] = time.time() - start
+        profiler.create_stats()
+        profile["stats"] = profiler.stats
+
+
+# Bundles of notebook code are kept unpacked by warm containers, so each
+# one is only downloaded the first time that a container needs it
+BUNDLE_DIR = "/tmp/bundles"
+bundles = {}
+active_bundle = []
+
+
+def use_bundle(key, globalenv):
+    """Make the local modules of a bundle importable, and define the
+    functions and classes from the notebook in the globals of the cell"""
+    if key not in bundles:
+        import io
+        import zipfile
+
+        path = os.path.join(BUNDLE_DIR, os.path.basename(key)[: -len(".zip")])
+        zipfile.ZipFile(io.BytesIO(load(key))).extractall(path)
+        with open(os.path.join(path, "__definitions__.py"), "r") as f:
+            bundles[key] = (path, compile(f.read(), "<notebook>", "exec"))
+
+    path, definitions = bundles[key]
+    if active_bundle != [key]:
+        # modules imported from the previous bundle are forgotten so
+        # that they are imported again from this one
+        if active_bundle:
+            previous = bundles[active_bundle[0]][0]
+            sys.path.remove(previous)
+            for name, module in list(sys.modules.items()):
+                module_path = getattr(module, "__file__", None) or ""
+                if module_path.startswith(previous + os.sep):
+                    del sys.modules[name]
+        sys.path.insert(0, path)
+        active_bundle[:] = [key]
+
+    exec(definitions, globalenv)
+
+
+def cancel_checker(key, interval=1.0):
+    """Make a function which tells a cell whether its map was cancelled,
+    which checks for the cancel flag in S3 at most once per interval"""
+    state = {"checked": 0, "cancelled": False}
+
+    def cancelled():
+        if not state["cancelled"] and time.time() - state["checked"] >= interval:
+            state["checked"] = time.time()
+            ctx = get_ctx()
+            try:
+                ctx.s3Client.head_object(Bucket=ctx.bucket, Key=key)
+                state["cancelled"] = True
+            except Exception:
+                pass
+        return state["cancelled"]
+
+    return cancelled
+
+
+def stable_hash(key):
+    """The builtin hash of strings varies between processes, so
+    partitions are assigned with a checksum of the key's repr"""
+    return zlib.crc32(repr(key).encode("utf-8")) & 0xFFFFFFFF
+
+
+def write_partitions(shuffle, index, partitions):
+    """Save every partition of a mapper's output as one object, rather than
+    one object per partition, and return the byte range of each partition"""
+    if shuffle.get("combiner"):
+        combiner = compile(shuffle["combiner"], "<combiner>", "eval")
+        for part in partitions:
+            for key in part:
+                part[key] = [eval(combiner, {"KEY": key, "VALUES": part[key]})]
+
+    blobs = [
+        zlib.compress(pickle.dumps(list(part.items()), 2)) if part else b""
+        for part in partitions
+    ]
+    offsets = []
+    position = 0
+    for blob in blobs:
+        offsets.append([position, position + len(blob)])
+        position += len(blob)
+
+    key = "%smap/%d" % (shuffle["prefix"], index)
+    save(key, b"".join(blobs))
+    return {"key": key, "offsets": offsets}
+
+
+def gather_partition(ranges):
+    """Load one partition from the output of every mapper, and group all of
+    the values by key"""
+    get_ctx()
+    blobs = parallel_map(lambda r: load(r[0], r[1], r[2]), ranges, TRANSFER_CONCURRENCY)
+    grouped = {}
+    for blob in blobs:
+        for key, values in pickle.loads(zlib.decompress(blob)):
+            grouped.setdefault(key, []).extend(values)
+    return grouped
+
+
+# How much of an object is requested at a time when reading records
+RECORD_CHUNK = 1024 * 1024
+
+
+def read_range(s3_range, delimiter):
+    """Stream the part of an object assigned to a task by map_s3. Without
+    a delimiter this is the raw body of the range, otherwise it is an
+    iterator over the records which begin within the range"""
+    key, start, end, size = s3_range
+    if delimiter is None:
+        return load(key, start, end, stream=True)
+    return read_records(key, start, end, size, delimiter.encode("utf-8"))
+
+
+def read_records(key, start, end, size, delimiter):
+    # A record belongs to the range containing its first byte. So unless the
+    # range begins the object, we start a byte early and drop everything up
+    # to the first delimiter, and the last record is read past the range end
+    begin = max(start - 1, 0)
+
+    def chunks():
+        body = load(key, begin, end, stream=True)
+        for chunk in iter(lambda: body.read(RECORD_CHUNK), b""):
+            yield chunk
+        for position in range(end, size, RECORD_CHUNK):
+            yield load(key, position, min(position + RECORD_CHUNK, size))
+
+    # buffer holds what's left of the last record, which begins at offset,
+    # and is only trimmed once per chunk so that each record isn't copied
+    buffer = b""
+    offset = begin
+    skip = start > 0
+    for chunk in chunks():
+        searched = max(len(buffer) - len(delimiter) + 1, 0)
+        buffer += chunk
+        position = 0
+        found = buffer.find(delimiter, searched)
+        while found >= 0:
+            record = buffer[position:found]
+            record_start = offset + position
+            position = found + len(delimiter)
+            if skip:
+                skip = False
+            elif record_start >= end:
+                return
+            else:
+                yield record
+            found = buffer.find(delimiter, position)
+        buffer = buffer[position:]
+        offset += position
+        if offset >= end and not skip:
+            return
+    if buffer and not skip and offset < end:
+        yield buffer
+
+
+def lambda_reduce(event, context):
+    """Combine the values saved at each of the input keys by running the
+    reducer code with them as VALUES, and save the result at output_key"""
+    get_ctx()
+    values = parallel_map(
+        lambda key: decode_result(json.loads(load(key))),
+        event["inputs"],
+        TRANSFER_CONCURRENCY,
+    )
+    globalenv = {
+        "VALUES": values,
+        "BUCKET": event["s3_bucket"],
+        "SAVE": save,
+        "LOAD": load,
+    }
+    if "globals" in event:
+        for key in event["globals"]:
+            globalenv[key] = event["globals"][key]
+    if "bundle" in event:
+        use_bundle(event["bundle"], globalenv)
+    result = my_exec(event["code"], globalenv, globalenv)
+    save(event["output_key"], json.dumps(encode_result(result)))
+
+    return {
+        "machine": os.environ["AWS_LAMBDA_LOG_STREAM_NAME"],
+        "result": encode_result(event["output_key"]),
+    }
+
+
+def lambda_warm(event, context):
+    """Keep the container busy for a moment, so that concurrent WARM events
+    each start a separate container, and fetch the bundle the cell needs"""
+    start = time.time()
+    if "bundle" in event:
+        use_bundle(event["bundle"], {})
+    time.sleep(max(0, event["hold"] - (time.time() - start)))
+    return {"machine": os.environ["AWS_LAMBDA_LOG_STREAM_NAME"]}
+
+
+# The most invocations a single launcher will send itself, this also
+# bounds the number of threads and connections used by a launcher
+MAX_FANOUT = 100
+
+# Launchers have the same timeout as their tasks, so they stop waiting this
+# many seconds before they would time out, and leave the tasks which are
+# still running to be picked up by the notebook from S3
+LAUNCH_MARGIN = 10
+
+
+def lambda_launch(event, context):
+    """Invoke a share of a map from inside Lambda. If there are more tasks
+    than the fanout, they are split between sub-launchers instead, so the
+    time until every task is running grows logarithmically with the count"""
+    ctx = get_ctx()
+    remaining = context.get_remaining_time_in_millis() / 1000.0
+    deadline = time.time() + remaining - min(LAUNCH_MARGIN, remaining / 4)
+    tasks = decode_result(event["tasks"])
+    fanout = min(event["fanout"], MAX_FANOUT)
+
+    if len(tasks) > fanout:
+        groups = split_evenly(tasks, fanout)
+        events = [dict(event, tasks=encode_result(group)) for group in groups]
+    else:
+        groups = [[task] for task in tasks]
+        events = tasks
+
+    responses = invoke_until(ctx, context, events, deadline)
+
+    results = []
+    for child, group, res in zip(events, groups, responses):
+        if res is None:
+            # every task of a child that's still running saves its own
+            # response, which is where the notebook will look for it
+            results.extend(
+                {"type": "pending", "s3_key": task["result_key"]} for task in group
+            )
+        elif child["type"] == "LAUNCH" and isinstance(res, dict) and "results" in res:
+            results.extend(decode_result(res["results"]))
+        else:
+            # a failed sub-launcher takes every one of its tasks with it
+            results.extend([res] * len(group))
+
+    return {
+        "machine": os.environ["AWS_LAMBDA_LOG_STREAM_NAME"],
+        "results": encode_result(results),
+    }
+
+
+def invoke_until(ctx, context, events, deadline):
+    """Invoke every child at once, and stop waiting at the deadline for
+    the ones which are still running, whose responses are left as None"""
+    import threading
+
+    responses = [None] * len(events)
+
+    def invoke(i):
+        responses[i] = invoke_self(ctx, context, events[i])
+
+    threads = [threading.Thread(target=invoke, args=(i,)) for i in range(len(events))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return list(responses)
+
+
+def invoke_self(ctx, context, event):
+    # a child which can't be invoked, such as when it's throttled, fails
+    # on its own rather than taking the rest of the launcher's tasks with it
+    try:
+        res = ctx.lambdaClient.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="RequestResponse",
+            LogType="Tail",
+            Payload=json.dumps(event),
+        )
+    except Exception as e:
+        return {"errorMessage": str(e), "errorType": type(e).__name__}
+    data = json.loads(res["Payload"].read().decode("utf-8"))
+    if isinstance(data, dict):
+        data["log"] = base64.b64decode(res["LogResult"]).decode("utf-8")
+    return data
+
+
+def split_evenly(items, count):
+    """Split a list into at most `count` contiguous groups of similar size"""
+    count = max(1, min(count, len(items)))
+    size, extra = divmod(len(items), count)
+    groups = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def parallel_map(fn, items, workers):
+    """Apply fn to every item using a pool of threads, preserving order.
+    This avoids concurrent.futures so that it works on Python 2.7 too"""
+    import threading
+
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = list(enumerate(items))[::-1]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                i, item = pending.pop()
+            try:
+                results[i] = fn(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [
+        threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
 def encode_result(data):
+    return spill_result(pack_result(data))
+
+
+def pack_result(data):
     # TODO: automatically choose the highest pickle version which is compatible
 
     data = base64.b64encode(zlib.compress(pickle.dumps(data, 2))).decode("utf-8")
 
-    result = {"type": "b64+zlib+pickle", "data": data}
+    return {"type": "b64+zlib+pickle", "data": data}
+
 
-    if len(data) > 5 * 1024 * 1024:
+def spill_result(result, owner=None):
+    """Results too large to be sent directly are saved to S3 instead. Chunks
+    are named by their contents, so identical ones are only uploaded once."""
+    if len(result["data"]) > 5 * 1024 * 1024:
         import zipfile
         import json
 
@@ -148,13 +945,42 @@ def encode_result(data):
         hashed = hashlib.sha256(contents.encode("utf-8")).hexdigest()
         s3_key = "chunks/" + hashed
 
-        save(s3_key, contents)
+        ctx = get_ctx()
+        owner = owner or getattr(ctx, "owner", None)
+        if owner:
+            add_reference(owner, s3_key)
+        try:
+            touch(s3_key)
+        except Exception:
+            save(s3_key, contents)
 
         result = {"type": "s3", "s3_key": s3_key}
 
     return result
 
 
+def touch(key):
+    """Copy an object onto itself, which fails if it doesn't exist. This
+    resets its modification time, so that an object which is about to be
+    used again isn't garbage collected for being old."""
+    ctx = get_ctx()
+    ctx.s3Client.copy_object(
+        Bucket=ctx.bucket,
+        Key=key,
+        CopySource={"Bucket": ctx.bucket, "Key": key},
+        MetadataDirective="REPLACE",
+    )
+
+
+def add_reference(owner, key):
+    """Record that a job or alias uses an object in the bucket, so that it
+    isn't garbage collected while it's still needed"""
+    ctx = get_ctx()
+    ctx.s3Client.put_object(
+        Bucket=ctx.bucket, Key="refs/%s/%s" % (owner, key), Body=b""
+    )
+
+
 def decode_result(data):
     if data["type"] == "s3":
         import io